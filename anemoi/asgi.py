@@ -0,0 +1,171 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+from urllib.parse import parse_qs
+
+from anemoi import checkin
+from anemoi.context import build_context
+from anemoi.metrics import render
+from anemoi.reload import watch_config
+from anemoi.util import anlog, get_or_parse_yaml
+
+# check-ins spend most of their time waiting on bcrypt, the backend and provider APIs,
+# so many more of them than there are CPUs can run at once. each one holds a database
+# connection, so this stays below the backend's default of 20 pooled connections
+CHECKIN_THREADS = 16
+
+# a (content type, raw body) tuple is sent as is
+Response = Tuple[int, Union[str, Dict, Tuple[str, bytes]]]
+
+
+class Request:
+    def __init__(self, scope: Dict, body: bytes):
+        self.method: str = scope["method"]
+        self.path: str = scope["path"]
+        self.args = {
+            k: v[-1]
+            for k, v in parse_qs(scope.get("query_string", b"").decode()).items()
+        }
+        self.headers = {k.decode().lower(): v.decode() for k, v in scope["headers"]}
+        self.client: Optional[str] = (scope.get("client") or [None])[0]
+        self.body = body
+
+    @property
+    def is_json(self) -> bool:
+        return self.headers.get("content-type", "").startswith("application/json")
+
+    @classmethod
+    async def read(cls, scope: Dict, receive: Callable) -> "Request":
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                return cls(scope, body)
+
+
+# the same routes as anemoi.server, for ASGI servers like uvicorn. requests are read
+# and answered on the event loop, and each check-in runs in a worker thread so it
+# never blocks it
+class AnemoiASGI:
+    config: Dict[str, Any]
+
+    def __init__(self, context: Dict[str, Any]):
+        self.config = context
+        self.routes = {
+            "/": self.home,
+            "/status": self.status,
+            "/check-in": self.check_in,
+            "/metrics": self.metrics,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        request = await Request.read(scope, receive)
+        handler = self.routes.get(request.path)
+        try:
+            status, body = await handler(request) if handler else (404, "not found")
+        except Exception as e:
+            anlog.error(e)
+            status, body = 500, "internal server error"
+        if isinstance(body, tuple):
+            content_type, payload = body[0].encode(), body[1]
+        elif isinstance(body, dict):
+            content_type, payload = b"application/json", json.dumps(body).encode()
+        else:
+            content_type, payload = b"text/html; charset=utf-8", body.encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", content_type),
+                    (b"content-length", str(len(payload)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": payload})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                anlog.info("Starting anemoi...")
+                asyncio.get_running_loop().set_default_executor(
+                    ThreadPoolExecutor(CHECKIN_THREADS, thread_name_prefix="anemoi")
+                )
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # run a blocking call in a worker thread, with a backend connection borrowed for
+    # just that call
+    async def run_backend(self, fn: Callable, *args, **kwargs):
+        backend = self.config.get("anemoi.backend")
+
+        def call():
+            backend.connect()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                backend.close()
+
+        return await asyncio.to_thread(call)
+
+    def client_address(self, request: Request) -> Optional[str]:
+        ip_addr = request.headers.get("cf-connecting-ip")
+        if not ip_addr:
+            forwarded = request.headers.get("x-forwarded-for")
+            ip_addr = forwarded.split(",")[-1].strip() if forwarded else request.client
+        return ip_addr
+
+    async def home(self, request: Request) -> Response:
+        return 200, "anemoi server"
+
+    async def status(self, request: Request) -> Response:
+        if updates := self.config.get("anemoi.updates"):
+            return 200, {"updates": updates.stats()}
+        return 404, "not found"
+
+    async def metrics(self, request: Request) -> Response:
+        body, content_type = render()
+        return 200, (content_type, body)
+
+    async def check_in(self, request: Request) -> Response:
+        if request.method == "POST":
+            if not request.is_json:
+                return 400, "bad request"
+            try:
+                data = dict(json.loads(request.body))
+            except ValueError:
+                return 400, "bad request"
+        elif request.method == "GET":
+            data = {
+                "uuid": request.args.get("uuid"),
+                "secret": request.args.get("secret"),
+                "ip": request.args.get("ip"),
+            }
+        else:
+            return 405, "method not allowed"
+        return await self.run_backend(
+            checkin.check_in, self.config, data, self.client_address(request)
+        )
+
+
+# ASGI servers that can only import a factory with no arguments can point
+# ANEMOI_CONFIG at the config file instead
+def setup_asgi_server(config_file=None) -> AnemoiASGI:
+    if config_file is None:
+        config_file = os.path.expanduser(
+            os.environ.get("ANEMOI_CONFIG", "~/.anemoi/config.yml")
+        )
+    app = AnemoiASGI(build_context(get_or_parse_yaml(config_file)))
+    watch_config(config_file, app.config)
+    return app
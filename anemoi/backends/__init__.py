@@ -1,17 +1,75 @@
 import importlib
-from typing import Dict, List, Optional
+import os
+from typing import IO, Dict, Iterator, List, Optional
 
 from anemoi.client import Client
+from anemoi.ratelimit import Bucket, TokenBuckets
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+
+class BackendInUse(Exception):
+    pass
+
+
+# takes an exclusive lock on `<path>.lock` for as long as the returned file stays
+# open. backends that keep their data in memory and write it back use it, so a second
+# process fails right away instead of overwriting what the first one wrote
+def lock_file(path: str) -> Optional[IO]:
+    if fcntl is None:
+        return None
+    handle = open(f"{path}.lock", "a+")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        handle.seek(0)
+        owner = handle.read().strip()
+        handle.close()
+        raise BackendInUse(
+            f"{path} is in use by another anemoi process (pid {owner or 'unknown'}), "
+            "stop it first"
+        )
+    handle.truncate(0)
+    handle.write(str(os.getpid()))
+    handle.flush()
+    return handle
+
+
+# whether a domain passes the filters of Backend.iter_clients()
+def domain_matches(
+    domain: str, prefix: Optional[str] = None, zone: Optional[str] = None
+) -> bool:
+    if prefix and not domain.startswith(prefix):
+        return False
+    return not zone or domain == zone or domain.endswith(f".{zone}")
 
 
 class Backend:
+    _buckets: Optional[TokenBuckets] = None
+
     def __init__(self, config: Dict):
         # do something with your {'type':'aaa', 'vendor': 'bbb', 'path': 'ccc'} config here
         pass
 
+    # called at the start and end of every server request, e.g. to borrow a
+    # connection from a pool and give it back
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
     def add_client(self, client: Client):
         pass
 
+    # add many clients at once, in a single write where the backend allows it
+    def add_clients(self, clients: List[Client]):
+        for client in clients:
+            self.add_client(client)
+
     # return UUID if success, None if fail
     def delete_client(self, client: Client) -> Optional[str]:
         return None
@@ -22,13 +80,43 @@ class Backend:
     ) -> Optional[Client]:
         return None
 
-    def update_ip(self, client: Client, ip: str, version: int):
+    # only write if the stored IP differs, return True if anything was changed
+    def update_ip(self, client: Client, ip: str, version: int) -> bool:
+        return False
+
+    def update_secret(self, client: Client, secret_key: str):
+        pass
+
+    # record that the provider had `ip` for the client's IPv`version` record at `when`
+    def mark_synced(self, client: Client, ip: str, version: int, when: float):
         pass
 
     @property
     def clients(self) -> List[Client]:
         return []
 
+    # yields clients one at a time, only those whose domain starts with `prefix` and
+    # is in `zone` when given. backends should avoid loading every client at once
+    def iter_clients(
+        self, prefix: Optional[str] = None, zone: Optional[str] = None
+    ) -> Iterator[Client]:
+        for client in self.clients:
+            if domain_matches(client.domain, prefix, zone):
+                yield client
+
+    # token buckets for rate limiting, shared by every process using this backend.
+    # takes a token from each bucket and returns True only if all of them have one,
+    # otherwise none are taken. by default the buckets only live in this process
+    def take_tokens(self, buckets: List[Bucket]) -> bool:
+        if self._buckets is None:
+            self._buckets = TokenBuckets()
+        return self._buckets.take_tokens(buckets)
+
+    # forget buckets last used before `before`, they are full again by then. the
+    # in-process buckets expire on their own
+    def prune_tokens(self, before: float):
+        pass
+
 
 def init_backend(
     config: Dict,
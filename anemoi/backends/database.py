@@ -1,18 +1,40 @@
 import dataclasses
 from dataclasses import asdict
-from time import sleep
-from typing import Dict, Optional
+from time import sleep, time
+from typing import Dict, Iterator, List, Optional
 
-from peewee import CharField, Database, Model, OperationalError, Proxy, SqliteDatabase
+from peewee import (
+    CharField,
+    Database,
+    FloatField,
+    IntegerField,
+    IntegrityError,
+    Model,
+    OperationalError,
+    Proxy,
+    SqliteDatabase,
+    chunked,
+)
 from playhouse.db_url import connect
-from playhouse.shortcuts import model_to_dict
+from playhouse.migrate import SchemaMigrator, migrate
+from playhouse.pool import PooledSqliteDatabase
 
 from anemoi.backends import Backend
 from anemoi.client import Client
-from anemoi.util import anlog, limit_dict
+from anemoi.ratelimit import Bucket, refill
+from anemoi.util import anlog
 
 db_proxy = Proxy()
 
+# WAL lets readers carry on while a check-in is writing, and busy_timeout makes
+# concurrent writers wait for the lock instead of failing with "database is locked"
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 5000,
+    "cache_size": -16000,
+}
+
 
 class BaseModel(Model):
     class Meta:
@@ -20,21 +42,79 @@ class BaseModel(Model):
 
 
 class ClientModel(BaseModel):
-    domain = CharField(max_length=253)
-    uuid = CharField(max_length=36)
+    domain = CharField(max_length=253, index=True)
+    uuid = CharField(max_length=36, unique=True)
     secret_key = CharField()
     last_ip4 = CharField(max_length=15)
     last_ip6 = CharField(max_length=45)
+    synced_ip4 = CharField(max_length=15, default="")
+    synced_ip4_at = FloatField(default=0)
+    synced_ip6 = CharField(max_length=45, default="")
+    synced_ip6_at = FloatField(default=0)
+
+
+class SchemaVersion(BaseModel):
+    version = IntegerField()
+
+
+class RateLimitModel(BaseModel):
+    key = CharField(max_length=255, unique=True)
+    tokens = FloatField()
+    updated = FloatField()
+
+
+# migration N takes the schema from version N to N+1. tables created from scratch
+# already match the models, so they start at the latest version
+def add_client_indexes(migrator: SchemaMigrator) -> List:
+    table = ClientModel._meta.table_name
+    return [
+        migrator.add_index(table, ("uuid",), unique=True),
+        migrator.add_index(table, ("domain",)),
+    ]
+
+
+def add_synced_columns(migrator: SchemaMigrator) -> List:
+    table = ClientModel._meta.table_name
+    return [
+        migrator.add_column(table, name, getattr(ClientModel, name))
+        for name in ("synced_ip4", "synced_ip4_at", "synced_ip6", "synced_ip6_at")
+    ]
+
+
+MIGRATIONS = [add_client_indexes, add_synced_columns]
+
 
+def migrate_schema(db: Database, fresh: bool):
+    row = SchemaVersion.get_or_none()
+    if row is None:
+        row = SchemaVersion.create(version=len(MIGRATIONS) if fresh else 0)
+    migrator = SchemaMigrator.from_database(db)
+    for version in range(row.version, len(MIGRATIONS)):
+        anlog.info(f"Migrating database schema to version {version + 1}")
+        try:
+            with db.atomic():
+                migrate(*MIGRATIONS[version](migrator))
+                row.version = version + 1
+                row.save()
+        except IntegrityError:
+            anlog.error(
+                f"Database migration {version + 1} failed, check {ClientModel._meta.table_name} for duplicate uuids"
+            )
+            raise
 
-def entry_to_dataclass(entry: Model, dc):
-    return dc(
-        **limit_dict(model_to_dict(entry), [x.name for x in dataclasses.fields(dc)])
-    )
+
+# selected in Client's field order, so rows can be turned into Clients without
+# building a dict for each one
+CLIENT_COLUMNS = [getattr(ClientModel, x.name) for x in dataclasses.fields(Client)]
+
+
+def select_clients():
+    return ClientModel.select(*CLIENT_COLUMNS).tuples()
 
 
 class DatabaseBackend(Backend):
     db: Database = None
+    page_size: int = 1000
 
     def __init__(self, config: Dict):
         allowed_db_kinds = ["sqlite", "postgres", "mysql"]
@@ -43,24 +123,59 @@ class DatabaseBackend(Backend):
         connection = config.get("path")
         if kind not in allowed_db_kinds:
             raise Exception(f"Backend {kind} does not exist!")
+        pool_config = {
+            "max_connections": config.get("max_connections", 20),
+            "stale_timeout": config.get("stale_timeout", 300),
+        }
         if kind == "sqlite":
-            self.db = SqliteDatabase(connection)
+            # pooled connections get handed to whichever thread asks next
+            self.db = PooledSqliteDatabase(
+                connection,
+                pragmas=SQLITE_PRAGMAS,
+                check_same_thread=False,
+                **pool_config,
+            )
         elif kind in allowed_db_kinds[1:]:
-            self.db = connect(connection)
+            scheme, rest = connection.split("://", 1)
+            if not scheme.endswith("+pool"):
+                scheme = f"{scheme}+pool"
+            self.db = connect(f"{scheme}://{rest}", **pool_config)
         db_proxy.initialize(self.db)
         while True:
             try:
-                self.db.connect()
+                self.db.connect(reuse_if_open=True)
                 break
             except OperationalError:
                 anlog.error("Unable to connect to database, waiting to retry...")
                 sleep(5)
 
-        self.db.create_tables([ClientModel])
+        # existing client tables are only ever changed through migrate_schema()
+        fresh = not self.db.table_exists(ClientModel._meta.table_name)
+        if fresh:
+            self.db.create_tables([ClientModel])
+        self.db.create_tables([SchemaVersion, RateLimitModel])
+        migrate_schema(self.db, fresh)
+        # buckets untouched for a day are full again anyway
+        self.prune_tokens(time() - 86400)
+        # hand the connection back to the pool, requests borrow their own
+        self.close()
+
+    def connect(self):
+        self.db.connect(reuse_if_open=True)
+
+    def close(self):
+        if not self.db.is_closed():
+            self.db.close()
 
     def add_client(self, client: Client):
         ClientModel.create(**asdict(client))
 
+    # one transaction, in chunks that stay under sqlite's bound parameter limit
+    def add_clients(self, clients: List[Client]):
+        with self.db.atomic():
+            for batch in chunked((asdict(x) for x in clients), 100):
+                ClientModel.insert_many(batch).execute()
+
     def delete_client(self, client: Client):
         c = ClientModel.delete().where(ClientModel.uuid == client.uuid)
         if c.execute():
@@ -70,25 +185,101 @@ class DatabaseBackend(Backend):
     def get_client(
         self, uuid: Optional[str] = None, domain: Optional[str] = None
     ) -> Optional[Client]:
-        res: Optional[ClientModel] = None
+        res: Optional[tuple] = None
         if uuid:
-            res = ClientModel.get_or_none(ClientModel.uuid == uuid)
+            res = select_clients().where(ClientModel.uuid == uuid).first()
         elif domain:
-            res = ClientModel.get_or_none(ClientModel.domain == domain)
+            res = select_clients().where(ClientModel.domain == domain).first()
         if res:
-            return entry_to_dataclass(res, Client)
+            return Client(*res)
         return None
 
-    def update_ip(self, client: Client, ip: str, version: int):
-        if version == 4:
-            ClientModel.update({ClientModel.last_ip4: ip}).where(
-                ClientModel.uuid == client.uuid
-            ).execute()
+    def update_ip(self, client: Client, ip: str, version: int) -> bool:
+        field = ClientModel.last_ip4 if version == 4 else ClientModel.last_ip6
+        # single conditional write: UPDATE ... WHERE uuid = ? AND last_ipX <> ?
+        updated = (
+            ClientModel.update({field: ip})
+            .where((ClientModel.uuid == client.uuid) & (field != ip))
+            .execute()
+        )
+        return updated > 0
+
+    def update_secret(self, client: Client, secret_key: str):
+        ClientModel.update({ClientModel.secret_key: secret_key}).where(
+            ClientModel.uuid == client.uuid
+        ).execute()
+
+    def mark_synced(self, client: Client, ip: str, version: int, when: float):
+        ClientModel.update(
+            {f"synced_ip{version}": ip, f"synced_ip{version}_at": when}
+        ).where(ClientModel.uuid == client.uuid).execute()
+
+    # buckets live in the database so every worker process shares them. sqlite takes
+    # the write lock up front: a read upgraded to a write mid-transaction fails with
+    # "database is locked" right away instead of waiting out busy_timeout
+    def take_tokens(self, buckets: List[Bucket]) -> bool:
+        now = time()
+        if isinstance(self.db, SqliteDatabase):
+            transaction = self.db.atomic("IMMEDIATE")
         else:
-            ClientModel.update({ClientModel.last_ip6: ip}).where(
-                ClientModel.uuid == client.uuid
-            ).execute()
+            transaction = self.db.atomic()
+        with transaction:
+            query = RateLimitModel.select().where(
+                RateLimitModel.key.in_([x[0] for x in buckets])
+            )
+            if self.db.for_update:
+                query = query.for_update()
+            rows = {row.key: row for row in query}
+            levels = [
+                (
+                    refill(rows[key].tokens, rows[key].updated, now, rate, burst)
+                    if key in rows
+                    else float(burst)
+                )
+                for key, rate, burst in buckets
+            ]
+            allowed = all(tokens >= 1 for tokens in levels)
+            for (key, _, _), tokens in zip(buckets, levels):
+                if key in rows:
+                    RateLimitModel.update(
+                        tokens=tokens - 1 if allowed else tokens, updated=now
+                    ).where(RateLimitModel.key == key).execute()
+                elif allowed:
+                    try:
+                        with self.db.atomic():
+                            RateLimitModel.create(
+                                key=key, tokens=tokens - 1, updated=now
+                            )
+                    except IntegrityError:
+                        # another worker created it first, let this one through
+                        pass
+        return allowed
+
+    def prune_tokens(self, before: float):
+        RateLimitModel.delete().where(RateLimitModel.updated < before).execute()
 
     @property
     def clients(self):
-        return [entry_to_dataclass(x, Client) for x in ClientModel.select()]
+        return [Client(*x) for x in select_clients()]
+
+    # keyset pagination on the primary key: every page is a short indexed query, so no
+    # cursor or transaction stays open while the caller works through the clients
+    def iter_clients(
+        self, prefix: Optional[str] = None, zone: Optional[str] = None
+    ) -> Iterator[Client]:
+        query = ClientModel.select(ClientModel.id, *CLIENT_COLUMNS)
+        if prefix:
+            query = query.where(ClientModel.domain.startswith(prefix))
+        if zone:
+            query = query.where(
+                (ClientModel.domain == zone) | ClientModel.domain.endswith(f".{zone}")
+            )
+        last = 0
+        while True:
+            page = query.where(ClientModel.id > last).order_by(ClientModel.id)
+            rows = list(page.limit(self.page_size).tuples())
+            for row in rows:
+                yield Client(*row[1:])
+            if len(rows) < self.page_size:
+                return
+            last = rows[-1][0]
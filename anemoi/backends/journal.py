@@ -0,0 +1,207 @@
+import atexit
+import json
+import os
+import threading
+from dataclasses import asdict, replace
+from typing import Dict, Iterator, List, Optional, Set
+
+from anemoi.client import Client
+from anemoi.util import anlog
+
+from . import Backend, domain_matches, lock_file
+
+
+# keeps every client in memory and appends each change to a log file. on startup the
+# last snapshot is loaded and the log is replayed on top of it. once the log gets long
+# enough, a new snapshot is written and the log starts over. every log entry can be
+# applied more than once safely, so a crash halfway through compaction loses nothing.
+# compaction rewrites the files from memory, so they are locked for as long as the
+# backend is open and a second process fails instead of having its entries dropped
+class JournalBackend(Backend):
+    clients_by_uuid: Dict[str, Client]
+    uuids_by_domain: Dict[str, Set[str]]
+
+    def __init__(self, config: Dict):
+        self.path = os.path.expanduser(config.get("path"))
+        self.snapshot_path = f"{self.path}.snapshot"
+        self.flush_size = config.get("flush_size", 100)
+        self.compact_size = config.get("compact_size", 10000)
+        self.clients_by_uuid = {}
+        self.uuids_by_domain = {}
+        self.lock = threading.RLock()
+        self.unsynced = 0
+        self.entries = 0
+
+        self.lock_handle = lock_file(self.path)
+        self.__load()
+        self.log = open(self.path, "a")
+        if self.entries >= self.compact_size:
+            self.compact()
+        self.stopped = threading.Event()
+        threading.Thread(
+            target=self.__sync_periodically,
+            args=(config.get("flush_interval", 5),),
+            name="anemoi-journal-sync",
+            daemon=True,
+        ).start()
+        atexit.register(self.shutdown)
+
+    def __load(self):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r") as fp:
+                for c in json.load(fp).get("clients", []):
+                    self.__apply({"op": "add", "client": c})
+        if not os.path.exists(self.path):
+            return
+        # bytes up to the end of the last complete entry
+        good = 0
+        with open(self.path, "rb") as fp:
+            for line in fp:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError
+                    entry = json.loads(line)
+                except ValueError:
+                    # a write that was cut short by a crash, nothing after it made it either
+                    anlog.error(f"Skipping incomplete entry at end of {self.path}")
+                    break
+                self.__apply(entry)
+                self.entries += 1
+                good += len(line)
+        # new entries are appended, so the broken one has to go or they would all end
+        # up after it and be skipped on the next start too
+        if good < os.path.getsize(self.path):
+            os.truncate(self.path, good)
+
+    def __apply(self, entry: Dict):
+        op = entry["op"]
+        if op == "add":
+            client = Client(**entry["client"])
+            self.clients_by_uuid[client.uuid] = client
+            self.uuids_by_domain.setdefault(client.domain, set()).add(client.uuid)
+        elif client := self.clients_by_uuid.get(entry["uuid"]):
+            if op == "delete":
+                del self.clients_by_uuid[client.uuid]
+                self.uuids_by_domain.get(client.domain, set()).discard(client.uuid)
+            elif op == "ip":
+                setattr(client, f"last_ip{entry['version']}", entry["ip"])
+            elif op == "secret":
+                client.secret_key = entry["secret_key"]
+            elif op == "synced":
+                setattr(client, f"synced_ip{entry['version']}", entry["ip"])
+                setattr(client, f"synced_ip{entry['version']}_at", entry["at"])
+
+    def __append(self, *entries: Dict):
+        with self.lock:
+            for entry in entries:
+                self.__apply(entry)
+            self.log.write("".join(f"{json.dumps(x)}\n" for x in entries))
+            self.log.flush()
+            self.unsynced += len(entries)
+            self.entries += len(entries)
+            if self.unsynced >= self.flush_size:
+                self.sync()
+            if self.entries >= self.compact_size:
+                self.compact()
+
+    def __sync_periodically(self, interval: float):
+        while not self.stopped.wait(interval):
+            self.sync()
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced and not self.log.closed:
+                os.fsync(self.log.fileno())
+                self.unsynced = 0
+
+    # write everything to a new snapshot and start an empty log
+    def compact(self):
+        with self.lock:
+            tmp_path = f"{self.snapshot_path}.tmp"
+            with open(tmp_path, "w") as fp:
+                json.dump(
+                    {"clients": [asdict(x) for x in self.clients_by_uuid.values()]}, fp
+                )
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            self.log.close()
+            self.log = open(self.path, "w")
+            os.fsync(self.log.fileno())
+            self.unsynced = 0
+            self.entries = 0
+
+    def shutdown(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        with self.lock:
+            self.sync()
+            self.log.close()
+            if self.lock_handle:
+                self.lock_handle.close()
+
+    def add_client(self, client: Client):
+        self.__append({"op": "add", "client": asdict(client)})
+
+    # written to the log in one go, and fsynced once if it's more than flush_size
+    def add_clients(self, clients: List[Client]):
+        self.__append(*({"op": "add", "client": asdict(x)} for x in clients))
+
+    def delete_client(self, client: Client) -> Optional[str]:
+        with self.lock:
+            if client.uuid not in self.clients_by_uuid:
+                return None
+            self.__append({"op": "delete", "uuid": client.uuid})
+        return client.uuid
+
+    def get_client(
+        self, uuid: Optional[str] = None, domain: Optional[str] = None
+    ) -> Optional[Client]:
+        res = None
+        if uuid:
+            res = self.clients_by_uuid.get(uuid)
+        elif domain:
+            uuids = self.uuids_by_domain.get(domain, set())
+            if len(uuids) == 1:
+                res = self.clients_by_uuid.get(next(iter(uuids)))
+        # callers get their own copy, the stored one only changes through the log
+        return replace(res) if res else None
+
+    def update_ip(self, client: Client, ip: str, version: int) -> bool:
+        with self.lock:
+            stored = self.clients_by_uuid.get(client.uuid)
+            if not stored or getattr(stored, f"last_ip{version}") == ip:
+                return False
+            self.__append(
+                {"op": "ip", "uuid": client.uuid, "version": version, "ip": ip}
+            )
+        return True
+
+    def update_secret(self, client: Client, secret_key: str):
+        self.__append({"op": "secret", "uuid": client.uuid, "secret_key": secret_key})
+
+    def mark_synced(self, client: Client, ip: str, version: int, when: float):
+        self.__append(
+            {
+                "op": "synced",
+                "uuid": client.uuid,
+                "version": version,
+                "ip": ip,
+                "at": when,
+            }
+        )
+
+    @property
+    def clients(self) -> List[Client]:
+        with self.lock:
+            return [replace(x) for x in self.clients_by_uuid.values()]
+
+    def iter_clients(
+        self, prefix: Optional[str] = None, zone: Optional[str] = None
+    ) -> Iterator[Client]:
+        with self.lock:
+            stored = list(self.clients_by_uuid.values())
+        for client in stored:
+            if domain_matches(client.domain, prefix, zone):
+                yield replace(client)
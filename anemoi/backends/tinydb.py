@@ -1,23 +1,121 @@
+import atexit
+import os
+import threading
 from dataclasses import asdict
-from typing import Dict, Optional
+from typing import Dict, Iterator, List, Optional, Set
 
-from tinydb import Query, TinyDB
+from tinydb import JSONStorage, Query, TinyDB
+from tinydb.middlewares import CachingMiddleware
 
 from anemoi.client import Client
 
-from . import Backend
+from . import Backend, domain_matches, lock_file
+
+
+class FsyncJSONStorage(JSONStorage):
+    def close(self):
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+        super().close()
 
 
 class TinydbBackend(Backend):
     db: TinyDB
+    # with vendor 'cached', this process owns the file: documents are served from
+    # memory through uuid/domain indexes and writes are flushed to disk in batches.
+    # a flush writes the whole file from memory, so the file is locked for as long as
+    # it is open and any other process using it fails instead of losing its writes
+    uuids: Optional[Dict[str, int]] = None
+    domains: Optional[Dict[str, Set[int]]] = None
 
     def __init__(self, config: Dict):
-        self.db = TinyDB(config.get("path"))
+        if config.get("vendor") != "cached":
+            self.db = TinyDB(config.get("path"))
+            return
+
+        self.lock_handle = lock_file(config.get("path"))
+        storage = CachingMiddleware(FsyncJSONStorage)
+        self.db = TinyDB(config.get("path"), storage=storage)
+        self.db.storage.WRITE_CACHE_SIZE = config.get("flush_size", 100)
+        self.lock = threading.RLock()
+        self.uuids = {}
+        self.domains = {}
+        for doc in self.db.all():
+            self.__index(doc.doc_id, doc)
+
+        self.stopped = threading.Event()
+        threading.Thread(
+            target=self.__flush_periodically,
+            args=(config.get("flush_interval", 5),),
+            name="anemoi-tinydb-flush",
+            daemon=True,
+        ).start()
+        atexit.register(self.shutdown)
+
+    def __index(self, doc_id: int, doc: Dict):
+        self.uuids[doc["uuid"]] = doc_id
+        self.domains.setdefault(doc["domain"], set()).add(doc_id)
+
+    def __unindex(self, doc_id: int, doc: Dict):
+        self.uuids.pop(doc["uuid"], None)
+        self.domains.get(doc["domain"], set()).discard(doc_id)
+
+    def __flush_periodically(self, interval: float):
+        while not self.stopped.wait(interval):
+            with self.lock:
+                self.db.storage.flush()
+
+    # flush anything still cached and fsync the file
+    def shutdown(self):
+        if self.uuids is None or self.stopped.is_set():
+            return
+        self.stopped.set()
+        with self.lock:
+            self.db.close()
+            if self.lock_handle:
+                self.lock_handle.close()
+
+    # change fields of a document in place in the write cache, without the
+    # full table rewrite a TinyDB update does
+    def __update_cached(self, uuid: str, fields: Dict) -> bool:
+        with self.lock:
+            tables = self.db.storage.read()
+            doc_id = self.uuids.get(uuid)
+            doc = tables.get(self.db.default_table_name, {}).get(str(doc_id))
+            if doc is None or all(doc.get(k) == v for k, v in fields.items()):
+                return False
+            doc.update(fields)
+            # counts towards the next flush
+            self.db.storage.write(tables)
+            return True
 
     def add_client(self, client: Client):
-        self.db.insert(asdict(client))
+        if self.uuids is None:
+            self.db.insert(asdict(client))
+            return
+        with self.lock:
+            doc = asdict(client)
+            self.__index(self.db.insert(doc), doc)
+
+    def add_clients(self, clients: List[Client]):
+        docs = [asdict(x) for x in clients]
+        if self.uuids is None:
+            self.db.insert_multiple(docs)
+            return
+        with self.lock:
+            for doc_id, doc in zip(self.db.insert_multiple(docs), docs):
+                self.__index(doc_id, doc)
 
     def delete_client(self, client: Client):
+        if self.uuids is not None:
+            with self.lock:
+                if (doc_id := self.uuids.get(client.uuid)) is None:
+                    return None
+                doc = self.db.get(doc_id=doc_id)
+                if len(self.db.remove(doc_ids=[doc_id])) == 1:
+                    self.__unindex(doc_id, doc)
+                    return client.uuid
+            return None
         client_query = Query()
         res = self.db.search(client_query.domain == client.domain)
         if len(res) == 1:
@@ -28,6 +126,15 @@ class TinydbBackend(Backend):
         return None
 
     def get_client(self, uuid=None, domain=None) -> Optional[Client]:
+        if self.uuids is not None:
+            doc_ids = set()
+            if uuid:
+                doc_ids = {self.uuids[uuid]} if uuid in self.uuids else set()
+            elif domain:
+                doc_ids = self.domains.get(domain, set())
+            if len(doc_ids) == 1 and (doc := self.db.get(doc_id=next(iter(doc_ids)))):
+                return Client(**doc)
+            return None
         client_query = Query()
         res = []
         if uuid:
@@ -38,12 +145,48 @@ class TinydbBackend(Backend):
             return Client(**res[0])
         return None
 
-    def update_ip(self, client: Client, ip: str, version: int):
+    def update_ip(self, client: Client, ip: str, version: int) -> bool:
         client_query = Query()
         ip_key = "last_ip4" if version == 4 else "last_ip6"
 
-        self.db.update({ip_key: ip}, (client_query.uuid == client.uuid))
+        if self.uuids is not None:
+            return self.__update_cached(client.uuid, {ip_key: ip})
+        updated = self.db.update(
+            {ip_key: ip},
+            (client_query.uuid == client.uuid) & (client_query[ip_key] != ip),
+        )
+        return len(updated) > 0
+
+    def update_secret(self, client: Client, secret_key: str):
+        if self.uuids is not None:
+            self.__update_cached(client.uuid, {"secret_key": secret_key})
+            return
+        client_query = Query()
+        self.db.update({"secret_key": secret_key}, (client_query.uuid == client.uuid))
+
+    # documents written before these fields existed still load, with the defaults
+    def mark_synced(self, client: Client, ip: str, version: int, when: float):
+        fields = {f"synced_ip{version}": ip, f"synced_ip{version}_at": when}
+        if self.uuids is not None:
+            self.__update_cached(client.uuid, fields)
+            return
+        client_query = Query()
+        self.db.update(fields, client_query.uuid == client.uuid)
 
     @property
     def clients(self):
         return [Client(**x) for x in self.db.all()]
+
+    # documents are turned into Clients one at a time as they are iterated
+    def iter_clients(
+        self, prefix: Optional[str] = None, zone: Optional[str] = None
+    ) -> Iterator[Client]:
+        if self.uuids is None:
+            docs = iter(self.db)
+        else:
+            # the write cache can change under us, iterate over a snapshot of it
+            with self.lock:
+                docs = list(self.db)
+        for doc in docs:
+            if domain_matches(doc["domain"], prefix, zone):
+                yield Client(**doc)
@@ -0,0 +1,90 @@
+import hashlib
+import hmac
+import threading
+from collections import OrderedDict
+from secrets import token_bytes
+from time import monotonic
+from typing import Any, Hashable, Optional
+
+
+# bounded, thread-safe LRU cache where every entry expires after a TTL
+class TTLCache:
+    def __init__(self, ttl: float = 300, maxsize: int = 4096):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires <= monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        if self.maxsize <= 0:
+            return
+        expires = monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[1] if entry else default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# remembers recent successful (uuid, secret) checks so bcrypt only has to run on a miss.
+# secrets are only ever stored as an HMAC keyed with a per-process random key. unknown
+# uuids are kept apart, so a flood of made-up uuids can only evict each other and never
+# the credentials of real clients
+class CredentialCache:
+    def __init__(
+        self,
+        ttl: float = 300,
+        maxsize: int = 4096,
+        unknown_ttl: float = 30,
+        unknown_maxsize: int = 4096,
+    ):
+        self._key = token_bytes(32)
+        self._cache = TTLCache(ttl, maxsize)
+        self._unknown = TTLCache(unknown_ttl, unknown_maxsize)
+
+    def _digest(self, uuid: str, secret: str) -> bytes:
+        return hmac.new(self._key, f"{uuid}:{secret}".encode(), hashlib.sha256).digest()
+
+    # secret_key is the stored bcrypt hash, so a rotated secret never matches an old entry
+    def check(self, uuid: str, secret: str, secret_key: str) -> bool:
+        entry = self._cache.get(uuid)
+        if entry is None or entry[0] != secret_key:
+            return False
+        return hmac.compare_digest(entry[1], self._digest(uuid, secret))
+
+    def remember(self, uuid: str, secret: str, secret_key: str):
+        self._cache.set(uuid, (secret_key, self._digest(uuid, secret)))
+
+    def is_unknown(self, uuid: str) -> bool:
+        return self._unknown.get(uuid, False)
+
+    def mark_unknown(self, uuid: str):
+        self._unknown.set(uuid, True)
+
+    def invalidate(self, uuid: str):
+        self._cache.pop(uuid)
+        self._unknown.pop(uuid)
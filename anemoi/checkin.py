@@ -0,0 +1,112 @@
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from anemoi.metrics import CHECKIN_SECONDS, CHECKINS, stage
+from anemoi.operator import ClientOperator
+from anemoi.providers import ProviderError, Providers
+from anemoi.ratelimit import RateLimiter
+from anemoi.updates import UpdateQueue
+from anemoi.util import PublicIP, anlog, ip_version, is_loopback, record_ip, record_type
+
+
+# the IP a check-in is for. clients on the same network as the server show up with a
+# loopback address, so the server's own public IP is used for them instead
+def resolve_ip(context: Mapping[str, Any], address: str) -> str:
+    if is_loopback(address):
+        public_ip: PublicIP = context.get("anemoi.public_ip")
+        new_ip = public_ip.get(ip_version(address))
+        return new_ip if new_ip else address
+    return address
+
+
+# everything a check-in does once the request has been read, for both the Flask and
+# the ASGI server. `data` holds the uuid, secret and optional ip the client sent, and
+# `address` is where the request came from. returns (status, body). it blocks on
+# bcrypt, the backend and the provider, and expects the backend to be connected
+@CHECKIN_SECONDS.time()
+def check_in(
+    context: Mapping[str, Any], data: Dict, address: Optional[str]
+) -> Tuple[int, str]:
+    if not all(k in data for k in ("uuid", "secret")):
+        return 400, "bad request"
+    uuid = data.get("uuid")
+    secret = data.get("secret")
+    manually_set_ip = data.get("ip")
+    # checked before any bcrypt or backend work is done
+    ratelimit: RateLimiter = context.get("anemoi.ratelimit")
+    if ratelimit and not ratelimit.allow(uuid, address):
+        CHECKINS.labels("rate_limited").inc()
+        return 429, "too many requests"
+    co = ClientOperator(
+        context.get("anemoi.backend"), context.get("anemoi.credentials")
+    )
+    # the client is read from the backend once and reused for the rest of the request
+    client = co.authenticate(uuid, secret)
+    if not client:  # no auth, exit
+        CHECKINS.labels("unauthenticated").inc()
+        return 200, "not changed"
+    providers: Providers = context.get("anemoi.providers")
+    provider = providers.get_provider(client.domain)
+    ip = manually_set_ip or resolve_ip(context, address)
+    rtype = record_type(ip)
+    # handle if IP changed on provider's side, then update it to the real one. what
+    # any server last saw at the provider is trusted for synced_ttl seconds
+    synced_ttl = context.get("anemoi.synced_ttl", 0)
+    providers_ip_record = co.synced_ip(client, rtype, synced_ttl)
+    if providers_ip_record is None:
+        with stage("get_record_ips"):
+            try:
+                records = provider.get_record_ips(client.domain, rtype=rtype)
+                # the record cache may have answered, and what it holds is only as
+                # fresh as when it was read
+                fetched_at = provider.fetched_at(client.domain, rtype)
+            except ProviderError as e:
+                # handled like a missing record, the update fails too if the
+                # provider is down
+                anlog.error(e)
+                records = []
+        providers_ip_record = record_ip(records, rtype)
+        if synced_ttl and providers_ip_record:
+            with stage("backend_write"):
+                co.mark_synced(client, providers_ip_record, rtype, fetched_at)
+    ip_changed = co.did_ip_change(uuid, ip, client=client)
+    updates: UpdateQueue = context.get("anemoi.updates")
+    waiting = updates.waiting_ip(client.domain, rtype) if updates else None
+    stale = waiting is not None and waiting != ip
+    if (
+        ip_changed
+        or stale
+        or not providers_ip_record
+        or (providers_ip_record and ip != providers_ip_record)
+    ):
+        if ip_changed:
+            with stage("backend_write"):
+                co.update_ip(uuid, ip, client=client)
+        if ip != providers_ip_record or stale:
+            # an older update that is still waiting would overwrite this one, so it
+            # has to go through the queue behind it
+            if updates and (stale or updates.defers(client.domain, rtype)):
+                updates.enqueue(client.domain, ip, rtype, client=client)
+                outcome = "queued"
+                msg = f"queued IP update for {client.domain} to {ip}"
+            else:
+                with stage("update_record_ip"):
+                    success = provider.update_record_ip(client.domain, ip, rtype=rtype)
+                if success:
+                    if updates:
+                        updates.mark_pushed(client.domain, rtype)
+                    if synced_ttl:
+                        with stage("backend_write"):
+                            co.mark_synced(client, ip, rtype)
+                    outcome = "provider"
+                    msg = f"changed IP for {client.domain} to {ip}"
+                else:
+                    outcome = "provider_error"
+                    msg = f"error updating IP for {client.domain}"
+        else:
+            outcome = "database"
+            msg = f"updated IP for {client.domain} to {ip} in database"
+        CHECKINS.labels(outcome).inc()
+        anlog.debug(msg)
+        return 200, msg
+    CHECKINS.labels("unchanged").inc()
+    return 200, "not changed"
@@ -1,10 +1,18 @@
+import csv
+import json
+import os
+from dataclasses import asdict
+from time import sleep
+from typing import Dict
+
 import click
 from jsonschema import ValidationError
 
-from anemoi.backends import init_backend
+from anemoi.backends import BackendInUse, init_backend
 from anemoi.operator import ClientOperator
-from anemoi.server import setup_server
+from anemoi.provisioning import read_entries
 from anemoi.util import get_or_parse_yaml, set_loglevel
+from anemoi.zones import ZoneTrie
 
 
 # walk up the ctx parent chain until you run into the desired parameter
@@ -25,6 +33,24 @@ def get_config(ctx):
     return config
 
 
+# validated like get_config(), but handed on as a path so the server can reload it
+def config_path(ctx) -> str:
+    get_config(ctx)
+    return os.path.expanduser(find_ctx_param(ctx, "config"))
+
+
+# backends that a running server holds on to can't be opened a second time
+def open_backend(ctx, config: Dict):
+    try:
+        return init_backend(config)
+    except BackendInUse as e:
+        ctx.fail(str(e))
+
+
+def config_zones(config: Dict) -> ZoneTrie:
+    return ZoneTrie(x.get("zone") for x in config.get("domains"))
+
+
 @click.group()
 @click.option("-v", is_flag=True)
 @click.option(
@@ -42,12 +68,59 @@ def cli(v, config):
 @cli.command()
 @click.option("-s", "--serve-host", help="IP/URL to serve anemoi", default="127.0.0.1")
 @click.option("-p", "--port", help="port for server", default=9999)
+@click.option("--asgi", is_flag=True, help="run the async server with uvicorn")
 @click.pass_context
-def server(ctx, serve_host, port):
-    app = setup_server(get_config(ctx))
+def server(ctx, serve_host, port, asgi):
+    # the web stacks are only imported by the commands that need them, so client
+    # commands start quickly
+    if asgi:
+        try:
+            import uvicorn
+        except ImportError:
+            ctx.fail("The async server needs uvicorn: pip install 'anemoi-dns[asgi]'")
+        from anemoi.asgi import setup_asgi_server
+
+        uvicorn.run(setup_asgi_server(config_path(ctx)), host=serve_host, port=port)
+        return
+    from anemoi.server import setup_server
+
+    app = setup_server(config_path(ctx))
     app.run(host=serve_host, port=port)
 
 
+@cli.command(help="push client IPs to providers where their records drifted")
+@click.option("-n", "--dry-run", is_flag=True, help="only show what would change")
+@click.option("-j", "--parallelism", default=4, help="zones worked on at once")
+@click.option("-i", "--interval", type=float, help="keep reconciling every N seconds")
+@click.pass_context
+def reconcile(ctx, dry_run, parallelism, interval):
+    from anemoi.providers import Providers
+    from anemoi.reconcile import Reconciler
+
+    config = get_config(ctx)
+    reconciler = Reconciler(
+        open_backend(ctx, config), Providers(config), parallelism=parallelism
+    )
+    while True:
+        fixes = reconciler.plan()
+        zone = None
+        for fix in sorted(fixes, key=lambda x: (x.zone, x.domain, x.rtype)):
+            if fix.zone != zone:
+                zone = fix.zone
+                click.echo(zone)
+            sign = "~" if fix.current else "+"
+            current = ", ".join(fix.current) or "(none)"
+            click.echo(f"  {sign} {fix.domain} {fix.rtype} {current} -> {fix.ip}")
+        if not fixes:
+            click.echo("No drifted records")
+        elif not dry_run:
+            pushed, failed = reconciler.apply(fixes)
+            click.echo(f"Updated {pushed} records, {failed} failed")
+        if not interval:
+            break
+        sleep(interval)
+
+
 @cli.group()
 def client():
     pass
@@ -59,15 +132,11 @@ def client():
 @click.pass_context
 def add(ctx, domain, ip):
     config = get_config(ctx)
-    backend = init_backend(config)
+    backend = open_backend(ctx, config)
     co = ClientOperator(backend)
     if not ip:
         ip = ""
-    zones = [x.get("zone") for x in config.get("domains")]
-    for zone in zones:
-        if domain.endswith(zone):
-            break
-    else:
+    if domain not in config_zones(config):
         ctx.fail(f"No zone defined for {domain}")
     client, secret = co.new_client(domain, ip)
     click.echo("\n- Client info -")
@@ -75,17 +144,87 @@ def add(ctx, domain, ip):
     click.echo(f"secret: {secret}")
 
 
+@client.command(name="import", help="add many clients from a CSV or JSON file")
+@click.argument("source", type=click.File("r"), default="-")
+@click.option(
+    "-f",
+    "--format",
+    "fmt",
+    type=click.Choice(["csv", "json"]),
+    help="format of SOURCE, guessed from its extension by default",
+)
+@click.option(
+    "-o",
+    "--output",
+    required=True,
+    type=click.Path(dir_okay=False, writable=True),
+    help="where to write each client's uuid and secret (.csv or .json)",
+)
+@click.option(
+    "-j",
+    "--processes",
+    type=int,
+    help="processes hashing secrets, one per CPU by default",
+)
+@click.pass_context
+def import_clients(ctx, source, fmt, output, processes):
+    config = get_config(ctx)
+    if not fmt:
+        fmt = "json" if source.name.endswith((".json", ".jsonl")) else "csv"
+    backend = open_backend(ctx, config)
+    co = ClientOperator(backend)
+    existing = {x.domain for x in co.iter_clients()}
+    entries, errors = read_entries(source, fmt, config_zones(config).match, existing)
+    if errors:
+        ctx.fail("Nothing was imported:\n" + "\n".join(errors))
+    if not entries:
+        click.echo("No clients to import")
+        return
+    # the secrets can't be recovered later, so make sure they have somewhere to go first
+    # and keep them readable only by the current user
+    out = os.fdopen(os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w")
+    with out:
+        created = co.new_clients(
+            ((x.domain, x.ip4, x.ip6) for x in entries), processes=processes
+        )
+        rows = [
+            {"domain": c.domain, "uuid": c.uuid, "secret": secret}
+            for c, secret in created
+        ]
+        if output.endswith(".json"):
+            json.dump(rows, out, indent=2)
+        else:
+            writer = csv.DictWriter(out, ["domain", "uuid", "secret"])
+            writer.writeheader()
+            writer.writerows(rows)
+    click.echo(f"Imported {len(created)} clients, credentials written to {output}")
+
+
 @client.command(help="list all clients")
+@click.option("-z", "--zone", help="only clients in this zone")
+@click.option("-p", "--prefix", help="only clients whose domain starts with this")
+@click.option("--json", "as_json", is_flag=True, help="print a JSON array")
 @click.pass_context
-def list(ctx):
-    backend = init_backend(get_config(ctx))
+def list(ctx, zone, prefix, as_json):
+    backend = open_backend(ctx, get_config(ctx))
     co = ClientOperator(backend)
-    if len(co.clients) == 0:
+    # clients are printed as they come out of the backend, never all held at once
+    count = 0
+    for client in co.iter_clients(prefix=prefix, zone=zone):
+        if as_json:
+            fields = {k: v for k, v in asdict(client).items() if k != "secret_key"}
+            click.echo(
+                ("[\n  " if count == 0 else ",\n  ") + json.dumps(fields), nl=False
+            )
+        else:
+            if count == 0:
+                click.echo("Clients:")
+            click.echo(f" - {client.uuid} ({client.domain})")
+        count += 1
+    if as_json:
+        click.echo("\n]" if count else "[]")
+    elif count == 0:
         click.echo("No clients found")
-        exit(0)
-    click.echo("Clients:")
-    for client in co.clients:
-        click.echo(f" - {client.uuid} ({client.domain})")
 
 
 @client.command(help="delete clients")
@@ -95,7 +234,7 @@ def list(ctx):
 def delete(ctx, domain, uuid):
     if (not domain and not uuid) or (uuid and domain):
         ctx.fail("Specify one of 'uuid' or 'domain'.")
-    backend = init_backend(get_config(ctx))
+    backend = open_backend(ctx, get_config(ctx))
     co = ClientOperator(backend)
     if domain:
         res = co.delete_client(domain=domain)
@@ -107,5 +246,23 @@ def delete(ctx, domain, uuid):
         click.echo("No matching clients found")
 
 
+@client.command(help="rotate a client's secret")
+@click.option("-d", "--domain", help="domain of client to rotate")
+@click.option("-u", "--uuid", help="UUID of client to rotate")
+@click.pass_context
+def rotate(ctx, domain, uuid):
+    if (not domain and not uuid) or (uuid and domain):
+        ctx.fail("Specify one of 'uuid' or 'domain'.")
+    backend = open_backend(ctx, get_config(ctx))
+    co = ClientOperator(backend)
+    if res := co.rotate_secret(uuid=uuid, domain=domain):
+        client, secret = res
+        click.echo("\n- Client info -")
+        click.echo(f"uuid: {client.uuid}")
+        click.echo(f"secret: {secret}")
+    else:
+        click.echo("No matching clients found")
+
+
 if __name__ == "__main__":
     cli()
@@ -8,3 +8,9 @@ class Client:
     secret_key: str
     last_ip4: str
     last_ip6: str
+    # the IP last seen at the provider for each record type, and when (unix time),
+    # so any server can skip asking the provider again for a while
+    synced_ip4: str = ""
+    synced_ip4_at: float = 0.0
+    synced_ip6: str = ""
+    synced_ip6_at: float = 0.0
@@ -0,0 +1,91 @@
+from typing import Any, Dict
+
+from anemoi.backends import init_backend
+from anemoi.cache import CredentialCache
+from anemoi.providers import Providers
+from anemoi.ratelimit import RateLimiter
+from anemoi.reconcile import Reconciler
+from anemoi.updates import UpdateQueue
+from anemoi.util import PublicIP
+
+
+def zone_damping(config: Dict) -> Dict[str, float]:
+    return {
+        x["zone"]: x["damping"] for x in config.get("domains", []) if "damping" in x
+    }
+
+
+# builds everything a server needs from a parsed config. the keys are the
+# ones the Flask app keeps in app.config
+def build_context(config: Dict) -> Dict[str, Any]:
+    context: Dict[str, Any] = {"anemoi.config": config}
+
+    # setup backend
+    backend = init_backend(config)
+    context["anemoi.backend"] = backend
+
+    # setup verified credential cache
+    cache_config = config.get("cache", {})
+    context["anemoi.credentials"] = CredentialCache(
+        ttl=cache_config.get("credential_ttl", 300),
+        maxsize=cache_config.get("credential_size", 4096),
+        unknown_ttl=cache_config.get("unknown_client_ttl", 30),
+        unknown_maxsize=cache_config.get("unknown_client_size", 4096),
+    )
+    # seconds a record state confirmed at the provider and stored in the backend is
+    # trusted, by every worker and replica sharing that backend
+    synced_ttl = cache_config.get("synced_ttl", 0)
+    context["anemoi.synced_ttl"] = synced_ttl
+
+    # optionally limit how often a uuid or client address can check in
+    if "ratelimit" in config:
+        context["anemoi.ratelimit"] = RateLimiter(config["ratelimit"], backend)
+
+    # for check-ins from this machine, which need its public IP instead
+    public_ip_config = config.get("public_ip", {})
+    sources = {
+        v: public_ip_config[f"ipv{v}_sources"]
+        for v in (4, 6)
+        if f"ipv{v}_sources" in public_ip_config
+    }
+    context["anemoi.public_ip"] = PublicIP(
+        sources,
+        ttl=public_ip_config.get("ttl", 300),
+        timeout=public_ip_config.get("timeout", 3),
+    )
+
+    # setup providers
+    providers = Providers(config_file=config)
+    context["anemoi.providers"] = providers
+
+    # optionally push provider updates from a background queue, and/or hold
+    # back updates for records that were pushed too recently
+    update_config = config.get("updates", {})
+    asynchronous = update_config.get("mode", "sync") == "async"
+    damping = zone_damping(config)
+    if asynchronous or update_config.get("damping") or damping:
+        updates = UpdateQueue(
+            providers,
+            workers=update_config.get("workers", 4),
+            asynchronous=asynchronous,
+            damping=update_config.get("damping", 0),
+            zone_damping=damping,
+            batch_size=update_config.get("batch_size", 100),
+            backend=backend if synced_ttl else None,
+        )
+        if update_config.get("restore", asynchronous):
+            updates.restore(backend)
+        context["anemoi.updates"] = updates
+
+    # optionally repair records that drifted on the provider's side in the background
+    reconcile_config = config.get("reconcile", {})
+    if interval := reconcile_config.get("interval"):
+        reconciler = Reconciler(
+            backend,
+            providers,
+            parallelism=reconcile_config.get("parallelism", 4),
+            updates=context.get("anemoi.updates"),
+        )
+        reconciler.start(interval)
+        context["anemoi.reconciler"] = reconciler
+    return context
@@ -0,0 +1,60 @@
+import os
+from typing import Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# with PROMETHEUS_MULTIPROC_DIR set before anemoi is imported, every worker writes its
+# metrics to files in that directory and /metrics adds them all up
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+# unauthenticated, unchanged, database, queued, provider, provider_error or rate_limited
+CHECKINS = Counter("anemoi_checkins_total", "Check-ins by outcome", ["outcome"])
+CHECKIN_SECONDS = Histogram(
+    "anemoi_checkin_seconds", "Time taken by a whole check-in request"
+)
+STAGE_SECONDS = Histogram(
+    "anemoi_checkin_stage_seconds",
+    "Time spent in each stage of a check-in",
+    ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+# counted per provider method, not per API request: an update may look the record up
+# first, and a lookup may need the zone ID or one query per record type
+PROVIDER_OPERATIONS = Counter(
+    "anemoi_provider_operations_total",
+    "Provider operations (lookups, updates, zone listings) that were not cached",
+    ["provider", "zone", "method"],
+)
+PROVIDER_OPERATION_ERRORS = Counter(
+    "anemoi_provider_operation_errors_total",
+    "Provider operations that raised or reported a failed update",
+    ["provider", "zone", "method"],
+)
+
+
+# time a block of code as a check-in stage: with stage("validate_secret"): ...
+def stage(name: str):
+    return STAGE_SECONDS.labels(name).time()
+
+
+# returns (body, content type) for the /metrics endpoint
+def render() -> Tuple[bytes, str]:
+    if not MULTIPROCESS:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+# for gunicorn's child_exit hook, so metrics of dead workers aren't reported as live
+def child_exit(server, worker):
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,53 +1,159 @@
+from concurrent.futures import ProcessPoolExecutor
 from secrets import choice, token_urlsafe
-from typing import Optional
+from time import time
+from typing import Iterable, Iterator, List, Optional, Tuple
 from uuid import uuid4
 
 import bcrypt
 
 from anemoi.backends import Backend
+from anemoi.cache import CredentialCache
 from anemoi.client import Client
 from anemoi.util import hash_password, ip_version
 
 
+def new_secret() -> str:
+    # bcrypt max length is 72 characters
+    # generate a random string that is URL safe/printable but also has a length between 64 and 72 bytes
+    return token_urlsafe(64)[: choice(range(64, 72))]
+
+
 class ClientOperator:
     backend: Backend
+    credentials: Optional[CredentialCache]
 
-    def __init__(self, backend):
+    def __init__(self, backend, credentials: Optional[CredentialCache] = None):
         self.backend = backend
+        self.credentials = credentials
 
     def new_client(self, domain, firstIP4="", firstIP6="") -> tuple[Client, str]:
         aID = str(uuid4())
-        # bcrypt max length is 72 characters
-        # generate a random string that is URL safe/printable but also has a length between 64 and 72 bytes
-        aSecret = token_urlsafe(64)[: choice(range(64, 72))]
+        aSecret = new_secret()
         # firstIP can be blank
         client = Client(domain, aID, hash_password(aSecret), firstIP4, firstIP6)
         self.backend.add_client(client)
+        if self.credentials:
+            self.credentials.invalidate(aID)
         return client, aSecret
 
+    # like new_client for many (domain, firstIP4, firstIP6) at once. secrets are hashed
+    # across `processes` worker processes and the clients are added in one bulk write
+    def new_clients(
+        self, entries: Iterable[Tuple[str, str, str]], processes: Optional[int] = None
+    ) -> List[tuple[Client, str]]:
+        entries = list(entries)
+        secrets = [new_secret() for _ in entries]
+        if processes == 1 or len(entries) < 2:
+            hashes = [hash_password(x) for x in secrets]
+        else:
+            with ProcessPoolExecutor(processes) as pool:
+                hashes = list(pool.map(hash_password, secrets, chunksize=16))
+        clients = [
+            Client(domain, str(uuid4()), secret_key, firstIP4, firstIP6)
+            for (domain, firstIP4, firstIP6), secret_key in zip(entries, hashes)
+        ]
+        self.backend.add_clients(clients)
+        if self.credentials:
+            for client in clients:
+                self.credentials.invalidate(client.uuid)
+        return list(zip(clients, secrets))
+
     def validate_secret(self, uuid, secret):
-        if client := self.backend.get_client(uuid=uuid):
-            return bcrypt.checkpw(secret.encode(), client.secret_key.encode())
-        return False
+        return self.authenticate(uuid, secret) is not None
+
+    # loads the client once and checks its secret against it, returns the Client on success.
+    # the returned snapshot can be passed to did_ip_change() and update_ip() to avoid re-reading it
+    def authenticate(self, uuid, secret) -> Optional[Client]:
+        # prometheus_client is only loaded by the server, not by client commands
+        from anemoi.metrics import stage
+
+        if self.credentials and self.credentials.is_unknown(uuid):
+            return None
+        with stage("backend_read"):
+            client = self.backend.get_client(uuid=uuid)
+        if client:
+            if self.credentials and self.credentials.check(
+                uuid, secret, client.secret_key
+            ):
+                return client
+            with stage("validate_secret"):
+                valid = bcrypt.checkpw(secret.encode(), client.secret_key.encode())
+            if not valid:
+                return None
+            if self.credentials:
+                self.credentials.remember(uuid, secret, client.secret_key)
+            return client
+        if self.credentials:
+            self.credentials.mark_unknown(uuid)
+        return None
 
     def delete_client(
         self, uuid: Optional[str] = None, domain: Optional[str] = None
     ) -> Optional[str]:
         if client := self.backend.get_client(uuid=uuid, domain=domain):
             deleted_uuid = self.backend.delete_client(client)
+            if self.credentials:
+                self.credentials.invalidate(client.uuid)
             return deleted_uuid
         return None
 
+    # returns (client, new secret) if success, None if no client matched
+    def rotate_secret(
+        self, uuid: Optional[str] = None, domain: Optional[str] = None
+    ) -> Optional[tuple[Client, str]]:
+        if client := self.backend.get_client(uuid=uuid, domain=domain):
+            aSecret = new_secret()
+            client.secret_key = hash_password(aSecret)
+            self.backend.update_secret(client, client.secret_key)
+            if self.credentials:
+                self.credentials.invalidate(client.uuid)
+            return client, aSecret
+        return None
+
     @property
     def clients(self):
         return self.backend.clients
 
-    def update_ip(self, uuid: str, ip: str):
-        if client := self.backend.get_client(uuid=uuid):
-            self.backend.update_ip(client, ip, ip_version(ip))
+    def iter_clients(
+        self, prefix: Optional[str] = None, zone: Optional[str] = None
+    ) -> Iterator[Client]:
+        return self.backend.iter_clients(prefix=prefix, zone=zone)
+
+    # returns True if the stored IP was changed
+    def update_ip(self, uuid: str, ip: str, client: Optional[Client] = None) -> bool:
+        if client := client or self.backend.get_client(uuid=uuid):
+            version = ip_version(ip)
+            if not self.backend.update_ip(client, ip, version):
+                return False
+            if version == 4:
+                client.last_ip4 = ip
+            else:
+                client.last_ip6 = ip
+            return True
+        return False
+
+    # the IP the provider was last seen with for this client's rtype record, if that
+    # was less than `ttl` seconds ago, by this or any other server
+    @staticmethod
+    def synced_ip(client: Client, rtype: str, ttl: float) -> Optional[str]:
+        version = 4 if rtype == "A" else 6
+        synced_at = getattr(client, f"synced_ip{version}_at")
+        if ttl > 0 and synced_at and time() - synced_at < ttl:
+            return getattr(client, f"synced_ip{version}") or None
+        return None
+
+    # `when` is when the provider was seen with this ip, now if not given
+    def mark_synced(
+        self, client: Client, ip: str, rtype: str, when: Optional[float] = None
+    ):
+        version = 4 if rtype == "A" else 6
+        when = time() if when is None else when
+        self.backend.mark_synced(client, ip, version, when)
+        setattr(client, f"synced_ip{version}", ip)
+        setattr(client, f"synced_ip{version}_at", when)
 
-    def did_ip_change(self, uuid, ip) -> bool:
-        if client := self.backend.get_client(uuid=uuid):
+    def did_ip_change(self, uuid, ip, client: Optional[Client] = None) -> bool:
+        if client := client or self.backend.get_client(uuid=uuid):
             if ip_version(ip) == 4:
                 return client.last_ip4 != ip
             else:
@@ -1,48 +1,243 @@
 import importlib
-from typing import Dict, List, Optional
+import importlib.util
+import threading
+from time import time
+from typing import Dict, List, Optional, Tuple
 
+from anemoi.cache import TTLCache
+from anemoi.metrics import PROVIDER_OPERATION_ERRORS, PROVIDER_OPERATIONS
 from anemoi.util import anlog, get_or_parse_yaml
+from anemoi.zones import ZoneTrie
+
+RECORD_TYPES = ("A", "AAAA")
+
+# (subdomain, rtype, ip)
+Change = Tuple[str, str, str]
+
+
+# a lookup the provider couldn't answer, as opposed to one that found no records
+class ProviderError(Exception):
+    pass
 
 
 class Provider:
+    # whether update_record_ips() is a real bulk call rather than a loop
+    batches = False
+
     def __init__(self, config):
         pass
 
-    # returns list of {'A': '1.1.1.1'} objects
-    def get_record_ips(self, subdomain) -> List[Dict[str, str]]:
+    # returns list of {'A': '1.1.1.1'} objects, only of type rtype if it is given.
+    # raises ProviderError if the records couldn't be looked up
+    def get_record_ips(self, subdomain, rtype=None) -> List[Dict[str, str]]:
         return []
 
     # returns bool of if the update succeeded or not
     def update_record_ip(self, subdomain, ip, rtype="A", **kwargs) -> bool:
         return False
 
+    # when the records get_record_ips() last returned for (subdomain, rtype) were read
+    # from the provider. without a cache in front, that is just now
+    def fetched_at(self, subdomain, rtype) -> float:
+        return time()
+
+    # for many changes in one zone at once, returns whether each change succeeded.
+    # providers with a bulk API override this and set batches = True
+    def update_record_ips(self, zone, changes: List[Change]) -> List[bool]:
+        return [self.update_record_ip(x[0], x[2], rtype=x[1]) for x in changes]
+
+    # for bulk operations: returns {'sub.zone.com': [{'A': '1.1.1.1'}]} for every
+    # A/AAAA record in the zone with a single listing, or None if unsupported. raises
+    # ProviderError if the listing failed
+    def get_zone_record_ips(self, zone) -> Optional[Dict[str, List[Dict[str, str]]]]:
+        return None
+
+
+# counts every provider method call that gets past the cache, and the ones that raised
+# or reported a failed update, by provider and zone
+class MeteredProvider(Provider):
+    provider: Provider
+
+    def __init__(self, provider: Provider, name: str, zone: str):
+        self.provider = provider
+        self.labels = (name, zone)
+
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
+
+    @property
+    def batches(self) -> bool:
+        return self.provider.batches
+
+    def __counted(self, method: str, result) -> None:
+        PROVIDER_OPERATIONS.labels(*self.labels, method).inc()
+        if result is False or (isinstance(result, list) and False in result):
+            PROVIDER_OPERATION_ERRORS.labels(*self.labels, method).inc()
+
+    def __call(self, method: str, *args, **kwargs):
+        try:
+            result = getattr(self.provider, method)(*args, **kwargs)
+        except Exception:
+            self.__counted(method, False)
+            raise
+        self.__counted(method, result)
+        return result
+
+    def get_record_ips(self, subdomain, rtype=None) -> List[Dict[str, str]]:
+        return self.__call("get_record_ips", subdomain, rtype=rtype)
+
+    def update_record_ip(self, subdomain, ip, rtype="A", **kwargs) -> bool:
+        return self.__call("update_record_ip", subdomain, ip, rtype=rtype, **kwargs)
+
+    def get_zone_record_ips(self, zone) -> Optional[Dict[str, List[Dict[str, str]]]]:
+        return self.__call("get_zone_record_ips", zone)
+
+    def update_record_ips(self, zone, changes: List[Change]) -> List[bool]:
+        if not self.batches:
+            # count the single updates it is made of
+            return super().update_record_ips(zone, changes)
+        return self.__call("update_record_ips", zone, changes)
+
 
+# remembers record contents per (domain, rtype) so check-ins where nothing changed
+# don't have to call out to the provider at all. successful updates write through
+class CachedProvider(Provider):
+    provider: Provider
+    records: TTLCache
+
+    def __init__(self, provider: Provider, ttl: float = 60, maxsize: int = 4096):
+        self.provider = provider
+        self.records = TTLCache(ttl, maxsize)
+
+    # anything not cached goes straight to the wrapped provider
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
+
+    @property
+    def batches(self) -> bool:
+        return self.provider.batches
+
+    # entries are (time they were read or written, ips)
+    def __cached(self, subdomain, rtypes) -> Optional[List[Dict[str, str]]]:
+        cached = [self.records.get((subdomain, x)) for x in rtypes]
+        if all(x is not None for x in cached):
+            return [{t: ip} for t, (_, ips) in zip(rtypes, cached) for ip in ips]
+        return None
+
+    def __store(self, subdomain, rtypes, ips: List[Dict[str, str]]):
+        now = time()
+        for t in rtypes:
+            self.records.set((subdomain, t), (now, [x[t] for x in ips if t in x]))
+
+    def __updated(self, subdomain, ip, rtype, success: bool) -> bool:
+        if success:
+            self.records.set((subdomain, rtype), (time(), [ip]))
+        else:
+            # we don't know what state the record was left in
+            self.records.pop((subdomain, rtype))
+        return success
+
+    def get_record_ips(self, subdomain, rtype=None) -> List[Dict[str, str]]:
+        rtypes = (rtype,) if rtype else RECORD_TYPES
+        if (cached := self.__cached(subdomain, rtypes)) is not None:
+            return cached
+        ips = self.provider.get_record_ips(subdomain, rtype=rtype)
+        self.__store(subdomain, rtypes, ips)
+        return ips
+
+    # a cached answer can be up to ttl seconds old
+    def fetched_at(self, subdomain, rtype) -> float:
+        if (cached := self.records.get((subdomain, rtype))) is not None:
+            return cached[0]
+        return time()
+
+    def update_record_ip(self, subdomain, ip, rtype="A", **kwargs) -> bool:
+        success = self.provider.update_record_ip(subdomain, ip, rtype=rtype, **kwargs)
+        return self.__updated(subdomain, ip, rtype, success)
+
+    def update_record_ips(self, zone, changes: List[Change]) -> List[bool]:
+        if not self.batches:
+            return super().update_record_ips(zone, changes)
+        results = self.provider.update_record_ips(zone, changes)
+        for (subdomain, rtype, ip), success in zip(changes, results):
+            self.__updated(subdomain, ip, rtype, success)
+        return results
+
+    # a zone listing is complete, so it refreshes every name in it
+    def get_zone_record_ips(self, zone) -> Optional[Dict[str, List[Dict[str, str]]]]:
+        listing = self.provider.get_zone_record_ips(zone)
+        for subdomain, ips in (listing or {}).items():
+            self.__store(subdomain, RECORD_TYPES, ips)
+        return listing
+
+
+# each zone's provider, and the SDK behind it, is only imported and set up the first
+# time that zone is used, so commands and workers that never touch a zone don't pay
+# for it. when built from a reloaded config, the provider of every zone whose config
+# didn't change is carried over from `previous`, along with its caches
 class Providers:
-    providers: Dict[str, Provider]
+    providers: Dict[str, Optional[Provider]]
+    configs: Dict[str, Dict]
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, previous: Optional["Providers"] = None):
         self.providers = {}
+        self.lock = threading.Lock()
         conf = get_or_parse_yaml(config_file)
+        cache_config = conf.get("cache", {})
+        # (ttl, size) of the record cache in front of each provider
+        self.record_cache = (
+            cache_config.get("record_ttl", 60),
+            cache_config.get("record_size", 4096),
+        )
+        self.configs = {}
         for domain_config in conf.get("domains", []):
             provider_name = domain_config.get("provider", "")
-            zone = domain_config.get("zone")
-            provider_obj: Optional[Provider] = getattr(
-                importlib.import_module(f"anemoi.providers.{provider_name}"),
-                f"{provider_name.capitalize()}Provider",
-            )
-            if not provider_obj:
+            # a typo still fails at startup, without importing anything
+            if not importlib.util.find_spec(f"anemoi.providers.{provider_name}"):
                 raise ModuleNotFoundError(
                     f"No DNS provider named {provider_name.capitalize()}"
                 )
-            provider = provider_obj(domain_config)
-            if not provider:
-                anlog.error(
-                    f"Unable to authenticate on {provider_name.capitalize()} for {zone}"
-                )
-                continue
-            self.providers.update({zone: provider})
+            self.configs[domain_config.get("zone")] = domain_config
+        self.zones = ZoneTrie(self.configs)
+        if previous and previous.record_cache == self.record_cache:
+            for zone, domain_config in self.configs.items():
+                if (
+                    previous.configs.get(zone) == domain_config
+                    and zone in previous.providers
+                ):
+                    self.providers[zone] = previous.providers[zone]
+
+    def __create(self, zone: str) -> Optional[Provider]:
+        domain_config = self.configs[zone]
+        provider_name = domain_config.get("provider", "")
+        provider_obj: Optional[Provider] = getattr(
+            importlib.import_module(f"anemoi.providers.{provider_name}"),
+            f"{provider_name.capitalize()}Provider",
+        )
+        if not provider_obj:
+            raise ModuleNotFoundError(
+                f"No DNS provider named {provider_name.capitalize()}"
+            )
+        provider = provider_obj(domain_config)
+        if not provider:
+            anlog.error(
+                f"Unable to authenticate on {provider_name.capitalize()} for {zone}"
+            )
+            return None
+        provider = MeteredProvider(provider, provider_name, zone)
+        if self.record_cache[0] > 0:
+            provider = CachedProvider(provider, *self.record_cache)
+        return provider
+
+    # the longest configured zone the name is in, or the name itself if there is none
+    def get_zone(self, subdomain) -> str:
+        return self.zones.match(subdomain) or subdomain
 
     def get_provider(self, zone) -> Optional[Provider]:
-        if zone.count(".") > 1:
-            zone = ".".join(zone.split(".")[-2:])
-        return self.providers.get(zone)
+        zone = self.get_zone(zone)
+        if zone in self.providers or zone not in self.configs:
+            return self.providers.get(zone)
+        with self.lock:
+            if zone not in self.providers:
+                self.providers[zone] = self.__create(zone)
+            return self.providers[zone]
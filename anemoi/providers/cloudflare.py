@@ -1,92 +1,264 @@
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
-from cloudflare import APIError, Cloudflare
-from cloudflare.types import dns, zones
+from cloudflare import APIError, Cloudflare, NotFoundError
+from cloudflare.types import dns
 
-from anemoi.providers import Provider
+from anemoi.providers import RECORD_TYPES, Change, Provider, ProviderError
 from anemoi.util import anlog, is_ip_record_valid
+from anemoi.zones import ZoneTrie
 
 
 class CloudflareProvider(Provider):
+    batches = True
+    # the most changes the batch endpoint takes at once on every plan
+    batch_size = 200
     API: Cloudflare = None
+    credentials: Dict[str, str]
+    # zone name -> zone ID, resolved lazily and kept for the life of the process
+    zone_ids: Dict[str, str]
+    zones: ZoneTrie
+    # (subdomain, rtype) -> records, so updates can go straight to an edit
+    records: Dict[Tuple[str, str], List[dns.RecordResponse]]
 
     # parse config
     def __init__(self, config):
+        self.zones = ZoneTrie([config.get("zone")])
+        self.zone_ids = {}
+        self.records = {}
+        self.credentials = {}
+        if token := config.get("token"):
+            self.credentials = {"api_token": token}
+        elif (email := config.get("email")) and (key := config.get("key")):
+            self.credentials = {"api_email": email, "api_key": key}
+        # for pointing at a local stand-in API, like the one in benchmarks
+        if self.credentials and (base_url := config.get("base_url")):
+            self.credentials["base_url"] = base_url
         try:  # noqa: SIM105
-            if token := config.get("token"):
-                self.API = Cloudflare(api_token=token)
-            elif (email := config.get("email")) and (key := config.get("key")):
-                self.API = Cloudflare(api_email=email, api_key=key)
+            if self.credentials:
+                self.API = Cloudflare(**self.credentials)
         except APIError:
             return None
 
-    def __get_zone_for_subdomain(self, subdomain):
-        zone = ".".join(subdomain.split(".")[-2:])
-        try:
-            zones = self.API.zones.list(name=zone)
-        except APIError as e:
-            anlog.error(e)
-            return None
+    def __zone_name(self, subdomain) -> str:
+        return self.zones.match(subdomain) or subdomain
+
+    def __store_zone(self, subdomain, zones) -> Optional[str]:
         if len(zones.result) != 1:
             anlog.error("Could not find zone")
             return None
-        return zones.result[0]
+        self.zone_ids[self.__zone_name(subdomain)] = zones.result[0].id
+        return zones.result[0].id
 
-    def __get_records(self, subdomain) -> tuple[List[dns.RecordResponse], str]:
-        zone: Optional[zones.Zone] = self.__get_zone_for_subdomain(subdomain)
-        if zone is None:
-            return []
-        zid = zone.id
+    def __get_zone_id(self, subdomain) -> Optional[str]:
+        if zid := self.zone_ids.get(self.__zone_name(subdomain)):
+            return zid
         try:
-            recs = self.API.dns.records.list(zone_id=zid, match="all", name=subdomain)
+            zones = self.API.zones.list(name=self.__zone_name(subdomain))
         except APIError as e:
             anlog.error(e)
-            return None, zid
+            return None
+        return self.__store_zone(subdomain, zones)
+
+    def __forget(self, subdomain):
+        self.zone_ids.pop(self.__zone_name(subdomain), None)
+        for rtype in ("A", "AAAA"):
+            self.records.pop((subdomain, rtype), None)
+
+    @staticmethod
+    def __list_params(zid, subdomain, rtype=None) -> Dict:
+        params = {"zone_id": zid, "match": "all", "name": subdomain}
+        if rtype:
+            params["type"] = rtype
+        return params
+
+    def __store_records(self, subdomain, rtype, recs) -> List[dns.RecordResponse]:
+        rtypes = (rtype,) if rtype else ("A", "AAAA")
         if len(recs.result) == 0:
             anlog.info(f"No records for {subdomain} found!")
-            return None, zid
         # later, maybe implement something to follow CNAMEs within the same domain
         # might want to have an explicit switch for that though
-        return [x for x in recs.result if x.type in ("A", "AAAA")], zid
+        recs = [x for x in recs.result if x.type in rtypes]
+        for t in rtypes:
+            self.records[(subdomain, t)] = [x for x in recs if x.type == t]
+        return recs
+
+    def __get_records(
+        self, subdomain, rtype=None
+    ) -> tuple[Optional[List[dns.RecordResponse]], str]:
+        zid = self.__get_zone_id(subdomain)
+        if zid is None:
+            return None, None
+        try:
+            recs = self.API.dns.records.list(
+                **self.__list_params(zid, subdomain, rtype)
+            )
+        except APIError as e:
+            anlog.error(e)
+            return None, zid
+        return self.__store_records(subdomain, rtype, recs), zid
 
     # returns list of {'A': '1.1.1.1'} objects
-    def get_record_ips(self, subdomain) -> List[Dict[str, str]]:
-        recs, _ = self.__get_records(subdomain)
-        if recs:
-            return [{x.type: x.content} for x in recs]
-        return []
+    def get_record_ips(self, subdomain, rtype=None) -> List[Dict[str, str]]:
+        recs, _ = self.__get_records(subdomain, rtype)
+        if recs is None:
+            raise ProviderError(f"Could not look up records for {subdomain}")
+        return [{x.type: x.content} for x in recs]
 
-    # returns bool of if the update succeeded or not
-    def update_record_ip(self, subdomain, ip, rtype="A", proxied=False) -> bool:
-        if not is_ip_record_valid(ip, rtype):
-            return False
+    # the whole zone's A/AAAA records in one listing, also kept for later updates
+    def get_zone_record_ips(self, zone) -> Optional[Dict[str, List[Dict[str, str]]]]:
+        zid = self.__get_zone_id(zone)
+        if zid is None:
+            raise ProviderError(f"Could not find the zone id for {zone}")
+        found: Dict[Tuple[str, str], List[dns.RecordResponse]] = {}
+        try:
+            # iterating goes through every page
+            for rec in self.API.dns.records.list(zone_id=zid, per_page=5000):
+                if rec.type in RECORD_TYPES:
+                    found.setdefault((rec.name, rec.type), []).append(rec)
+        except APIError as e:
+            raise ProviderError(f"Could not list {zone}: {e}") from e
+        result: Dict[str, List[Dict[str, str]]] = {}
+        for (name, rtype), recs in found.items():
+            self.records[(name, rtype)] = recs
+            result.setdefault(name, []).extend({rtype: x.content} for x in recs)
+        return result
 
-        recs, zid = self.__get_records(subdomain)
-        if recs:
-            recs = [x for x in recs if x.type == rtype]
-        if not recs:  # create new record
-            try:
-                self.API.dns.records.create(
-                    zone_id=zid, name=subdomain, type=rtype, content=ip
-                )
-            except APIError as e:
-                anlog.error(e)
-                return False
+    @staticmethod
+    def __edit_params(zid, subdomain, ip, rec) -> Dict:
+        return {
+            "dns_record_id": rec.id,
+            "zone_id": zid,
+            "name": subdomain,
+            "type": rec.type,
+            "content": ip,
+            "proxied": rec.proxied,
+            "ttl": rec.ttl,
+        }
+
+    def __set_record_ip(self, subdomain, ip, rtype, zid, recs) -> bool:
+        if not recs:  # create new record, ttl 1 is automatic
+            rec = self.API.dns.records.create(
+                zone_id=zid, name=subdomain, type=rtype, content=ip, ttl=1
+            )
+            self.records[(subdomain, rtype)] = [rec] if rec else []
             return True
 
+        updated = []
         for rec in recs:
             if ip == rec.content:
+                updated.append(rec)
                 continue  # dont update if we dont have to
+            updated.append(
+                self.API.dns.records.edit(**self.__edit_params(zid, subdomain, ip, rec))
+            )
+        self.records[(subdomain, rtype)] = [x for x in updated if x]
+        return True
+
+    # records that need changing go out in one batch request per batch_size changes.
+    # records we don't know yet are found with a single zone listing first
+    def update_record_ips(self, zone, changes: List[Change]) -> List[bool]:
+        results = [is_ip_record_valid(ip, rtype) for _, rtype, ip in changes]
+        unknown = [
+            i
+            for i, (subdomain, rtype, _) in enumerate(changes)
+            if results[i] and (subdomain, rtype) not in self.records
+        ]
+        # after a listing, names that still aren't known have no records yet
+        if unknown:
             try:
-                self.API.dns.records.edit(
-                    dns_record_id=rec.id,
+                self.get_zone_record_ips(zone)
+            except ProviderError as e:
+                anlog.error(e)
+                for i in unknown:
+                    results[i] = False
+        zid = self.__get_zone_id(zone)
+        if zid is None:
+            return [False] * len(changes)
+
+        pending = [i for i, ok in enumerate(results) if ok]
+        failed = self.__send_batches(zid, changes, pending)
+        if failed:
+            # one stale record ID fails the whole batch it is in, so list the zone
+            # again and retry those changes once with fresh IDs
+            for key in [x for x in self.records if self.__zone_name(x[0]) == zone]:
+                del self.records[key]
+            try:
+                self.get_zone_record_ips(zone)
+                failed = self.__send_batches(zid, changes, failed)
+            except ProviderError as e:
+                anlog.error(e)
+        # anything still failing goes one record at a time, so a bad record only
+        # fails its own change
+        for i in failed:
+            subdomain, rtype, ip = changes[i]
+            results[i] = self.update_record_ip(subdomain, ip, rtype=rtype)
+        return results
+
+    # sends the changes at `indices` in as few batch requests as possible and returns
+    # the indices of the changes whose batch failed
+    def __send_batches(
+        self, zid, changes: List[Change], indices: List[int]
+    ) -> List[int]:
+        # (index into changes, "patches" or "posts", record params)
+        ops: List[Tuple[int, str, Dict]] = []
+        for i in indices:
+            subdomain, rtype, ip = changes[i]
+            recs = self.records.get((subdomain, rtype), [])
+            if not recs:
+                post = {"name": subdomain, "type": rtype, "content": ip, "ttl": 1}
+                ops.append((i, "posts", post))
+            for rec in recs:
+                if rec.content != ip:
+                    patch = self.__edit_params(zid, subdomain, ip, rec)
+                    patch["id"] = patch.pop("dns_record_id")
+                    del patch["zone_id"]
+                    ops.append((i, "patches", patch))
+
+        failed = set()
+        for start in range(0, len(ops), self.batch_size):
+            batch = ops[start : start + self.batch_size]  # noqa: E203
+            try:
+                res = self.API.dns.records.batch(
                     zone_id=zid,
-                    name=subdomain,
-                    type=rec.type,
-                    content=ip,
-                    proxied=rec.proxied,
+                    patches=[x[2] for x in batch if x[1] == "patches"],
+                    posts=[x[2] for x in batch if x[1] == "posts"],
                 )
             except APIError as e:
+                # a batch is applied all or nothing
                 anlog.error(e)
+                failed.update(x[0] for x in batch)
+                continue
+            for rec in res.patches or []:
+                self.records[(rec.name, rec.type)] = [
+                    rec if x.id == rec.id else x
+                    for x in self.records.get((rec.name, rec.type), [])
+                ]
+            for rec in res.posts or []:
+                self.records[(rec.name, rec.type)] = [rec]
+        return sorted(failed)
+
+    # returns bool of if the update succeeded or not
+    def update_record_ip(self, subdomain, ip, rtype="A", proxied=False) -> bool:
+        if not is_ip_record_valid(ip, rtype):
+            return False
+
+        # first try with whatever record IDs we already know about, and if they
+        # turn out to be stale, look everything up again once
+        for _ in range(2):
+            zid = self.zone_ids.get(self.__zone_name(subdomain))
+            recs = self.records.get((subdomain, rtype))
+            if zid is None or recs is None:
+                _, zid = self.__get_records(subdomain, rtype)
+                recs = self.records.get((subdomain, rtype))
+                if zid is None or recs is None:
+                    return False
+            try:
+                return self.__set_record_ip(subdomain, ip, rtype, zid, recs)
+            except NotFoundError:
+                anlog.info(f"Cached records for {subdomain} are stale, retrying")
+                self.__forget(subdomain)
+            except APIError as e:
+                anlog.error(e)
+                self.__forget(subdomain)
                 return False
-        return True
+        return False
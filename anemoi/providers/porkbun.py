@@ -1,9 +1,10 @@
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import requests
 
-from anemoi.providers import Provider
+from anemoi.providers import Provider, ProviderError
 from anemoi.util import anlog, is_ip_record_valid
+from anemoi.zones import ZoneTrie
 
 
 class PorkbunProvider(Provider):
@@ -12,27 +13,32 @@ class PorkbunProvider(Provider):
     version = "v3"
     key: str = None
     secret: str = None
+    zones: ZoneTrie
 
     def __init__(self, config):
+        self.zones = ZoneTrie([config.get("zone")])
         if (apikey := config.get("apikey")) and (secret := config.get("secret")):
             self.key = apikey
             self.secret = secret
+            self.uri = config.get("uri", self.uri)
         else:
             anlog.error("Insufficient credentials for Porkbun")
             return None
 
-    def _post(self, endpoint, data=None):
+    def _request(self, endpoint, data=None) -> tuple[str, Dict]:
         if not data:
             data = {}
         data.update({"apikey": self.key, "secretapikey": self.secret})
-        res = requests.post(f"{self.uri}{self.version}/{endpoint}", json=data)
+        return f"{self.uri}{self.version}/{endpoint}", data
+
+    def _response(self, res):
         if res.status_code != 200:
             try:
                 if (output := res.json()) and output.get("status", "") == "ERROR":
                     raise Exception(
                         f"Error {res.status_code} on Porkbun API: {output.get('message','unknown')}"
                     )
-            except requests.exceptions.JSONDecodeError:
+            except ValueError:
                 raise Exception(f"Unknown error {res.status_code} on Porkbun API.")
         data = res.json()
         if data.get("status", "") != "SUCCESS":
@@ -40,54 +46,86 @@ class PorkbunProvider(Provider):
         data.pop("status", None)
         return data
 
-    def __get_records(self, subdomain) -> List[str]:
-        domain = ".".join(subdomain.split(".")[-2:])
-        recs = []
+    def _post(self, endpoint, data=None):
+        url, data = self._request(endpoint, data)
+        return self._response(requests.post(url, json=data))
+
+    def __split(self, subdomain: str) -> tuple[str, str]:
+        domain = self.zones.match(subdomain) or subdomain
+        name = subdomain[: -len(domain)].rstrip(".")
+        return domain, name
+
+    # only fetch the records for this exact name and type rather than the whole zone
+    def __records_endpoint(self, subdomain, rtype) -> str:
+        domain, name = self.__split(subdomain)
+        endpoint = f"dns/retrieveByNameType/{domain}/{rtype}"
+        if name:
+            endpoint = f"{endpoint}/{name}"
+        return endpoint
+
+    def __get_records(self, subdomain, rtype) -> List[Dict]:
         try:
-            res = self._post(f"dns/retrieve/{domain}")
-            raw_records = res.get("records", [])
-            targets = [x for x in raw_records if x.get("name", "") == subdomain]
-            if len(targets) != 0:
-                recs = targets
+            res = self._post(self.__records_endpoint(subdomain, rtype))
         except Exception as e:
-            anlog.error(e)
-        return recs
+            raise ProviderError(e) from e
+        return res.get("records", []) or []
 
-    # returns list of {'A': '1.1.1.1'} objects
-    def get_record_ips(self, subdomain) -> List[Dict[str, str]]:
+    @staticmethod
+    def __record_ips(recs: List[Dict]) -> List[Dict[str, str]]:
         result = []
-        recs = self.__get_records(subdomain)
         for rec in recs:
             if (kind := rec.get("type")) and (ip := rec.get("content")):
                 result.append({kind: ip})
         return result
 
+    # returns list of {'A': '1.1.1.1'} objects
+    def get_record_ips(self, subdomain, rtype=None) -> List[Dict[str, str]]:
+        result = []
+        for t in (rtype,) if rtype else ("A", "AAAA"):
+            result += self.__record_ips(self.__get_records(subdomain, t))
+        return result
+
+    # the full zone listing is only worth it when it can serve many names at once
+    def get_zone_record_ips(self, zone) -> Optional[Dict[str, List[Dict[str, str]]]]:
+        try:
+            res = self._post(f"dns/retrieve/{zone}")
+        except Exception as e:
+            raise ProviderError(e) from e
+        result: Dict[str, List[Dict[str, str]]] = {}
+        for rec in res.get("records", []):
+            kind = rec.get("type")
+            if kind in ("A", "AAAA") and (ip := rec.get("content")):
+                result.setdefault(rec.get("name", ""), []).append({kind: ip})
+        return result
+
+    # returns the (endpoint, data) to call to get the record to ip, None if it already is
+    def __update_request(
+        self, subdomain, ip, rtype, recs
+    ) -> Optional[tuple[str, Dict]]:
+        domain, name = self.__split(subdomain)
+        if not recs:
+            # need to create record
+            return f"dns/create/{domain}", {"name": name, "type": rtype, "content": ip}
+        if all(ip == rec.get("content", "") for rec in recs):
+            return None
+        return f"dns/editByNameType/{domain}/{rtype}/{name}", {"content": ip}
+
+    def __updated(self, subdomain, endpoint, res) -> bool:
+        if endpoint.startswith("dns/create/") and "id" not in res:
+            anlog.error(f"Failed to create record for {subdomain}")
+            return False
+        return True
+
     # returns bool of if the update succeeded or not
     def update_record_ip(self, subdomain: str, ip, rtype="A") -> bool:
         if not is_ip_record_valid(ip, rtype):
             return False
-        domain = ".".join(subdomain.split(".")[-2:])
-        recs = self.__get_records(subdomain)
-        name = "" if subdomain.count(".") <= 1 else subdomain.split(".", 1)[0]
         try:
-            if recs:
-                recs = [x for x in recs if x.get("type", "") == rtype]
-            else:
-                # need to create record
-                res = self._post(
-                    f"dns/create/{domain}", {"name": name, "type": rtype, "content": ip}
-                )
-                if "id" not in res:
-                    anlog.error(f"Failed to create record for {subdomain}")
-                    return False
-                return True
-            for rec in recs:
-                if ip == rec.get("content", ""):
-                    continue
-                res = self._post(
-                    f"dns/editByNameType/{domain}/{rtype}/{name}", {"content": ip}
-                )
+            # a failed lookup must not look like a missing record, or it gets created twice
+            recs = self.__get_records(subdomain, rtype)
+            if not (req := self.__update_request(subdomain, ip, rtype, recs)):
                 return True
+            return self.__updated(subdomain, req[0], self._post(*req))
         except Exception as e:
             anlog.error(e)
         return False
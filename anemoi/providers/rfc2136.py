@@ -0,0 +1,152 @@
+import socket
+from typing import Dict, List, Optional
+
+import dns.exception
+import dns.inet
+import dns.message
+import dns.name
+import dns.query
+import dns.rcode
+import dns.rdatatype
+import dns.tsig
+import dns.tsigkeyring
+import dns.update
+import dns.zone
+
+from anemoi.providers import RECORD_TYPES, Provider, ProviderError
+from anemoi.util import anlog, is_ip_record_valid
+
+
+# updates records on your own authoritative server (BIND, Knot, PowerDNS, ...) with
+# RFC 2136 dynamic updates, optionally signed with a TSIG key. lookups are asked of
+# that server directly so they never see a stale cached answer
+class Rfc2136Provider(Provider):
+    zone: dns.name.Name
+    server: str = None
+    port: int = 53
+    ttl: int = 300
+    timeout: float = 5
+    keyring: Optional[Dict] = None
+    keyname: Optional[dns.name.Name] = None
+    keyalgorithm: dns.name.Name = dns.tsig.HMAC_SHA256
+
+    def __init__(self, config):
+        if not (server := config.get("server")):
+            anlog.error("No server given for RFC 2136 provider")
+            return None
+        self.zone = dns.name.from_text(config.get("zone"))
+        self.server = server
+        self.port = config.get("port", self.port)
+        self.ttl = config.get("ttl", self.ttl)
+        self.timeout = config.get("timeout", self.timeout)
+        if (key_name := config.get("key_name")) and (
+            secret := config.get("key_secret")
+        ):
+            self.keyname = dns.name.from_text(key_name)
+            self.keyring = dns.tsigkeyring.from_text({key_name: secret})
+            if algorithm := config.get("key_algorithm"):
+                self.keyalgorithm = dns.name.from_text(algorithm)
+
+    # dnspython only talks to addresses, so a hostname is looked up once
+    def __address(self) -> str:
+        if not dns.inet.is_address(self.server):
+            self.server = socket.getaddrinfo(self.server, self.port)[0][4][0]
+        return self.server
+
+    def __signed(self, message: dns.message.Message) -> dns.message.Message:
+        if self.keyring:
+            message.use_tsig(self.keyring, self.keyname, algorithm=self.keyalgorithm)
+        return message
+
+    def __query(self, subdomain, rtype) -> dns.message.Message:
+        return self.__signed(dns.message.make_query(subdomain, rtype))
+
+    @staticmethod
+    def __record_ips(res: dns.message.Message, rtype) -> List[Dict[str, str]]:
+        if res.rcode() == dns.rcode.NXDOMAIN:
+            return []
+        if res.rcode() != dns.rcode.NOERROR:
+            raise ProviderError(f"Lookup refused: {dns.rcode.to_text(res.rcode())}")
+        return [
+            {rtype: rdata.address}
+            for rrset in res.answer
+            if rrset.rdtype == dns.rdatatype.from_text(rtype)
+            for rdata in rrset
+        ]
+
+    def __update(self, subdomain, ip, rtype) -> dns.update.UpdateMessage:
+        update = dns.update.UpdateMessage(self.zone)
+        # replaces every record of this type for the name with just this one
+        update.replace(dns.name.from_text(subdomain), self.ttl, rtype, ip)
+        return self.__signed(update)
+
+    def __updated(self, subdomain, res: dns.message.Message) -> bool:
+        if res.rcode() != dns.rcode.NOERROR:
+            anlog.error(
+                f"Update for {subdomain} refused: {dns.rcode.to_text(res.rcode())}"
+            )
+            return False
+        return True
+
+    # returns list of {'A': '1.1.1.1'} objects
+    def get_record_ips(self, subdomain, rtype=None) -> List[Dict[str, str]]:
+        result = []
+        for t in (rtype,) if rtype else RECORD_TYPES:
+            try:
+                res, _ = dns.query.udp_with_fallback(
+                    self.__query(subdomain, t),
+                    self.__address(),
+                    timeout=self.timeout,
+                    port=self.port,
+                )
+            except (dns.exception.DNSException, OSError) as e:
+                raise ProviderError(e) from e
+            result += self.__record_ips(res, t)
+        return result
+
+    # returns bool of if the update succeeded or not
+    def update_record_ip(self, subdomain, ip, rtype="A", **kwargs) -> bool:
+        if not is_ip_record_valid(ip, rtype):
+            return False
+        try:
+            res, _ = dns.query.udp_with_fallback(
+                self.__update(subdomain, ip, rtype),
+                self.__address(),
+                timeout=self.timeout,
+                port=self.port,
+            )
+        except (dns.exception.DNSException, OSError) as e:
+            anlog.error(e)
+            return False
+        return self.__updated(subdomain, res)
+
+    # one zone transfer, if the server allows it for our key
+    def get_zone_record_ips(self, zone) -> Optional[Dict[str, List[Dict[str, str]]]]:
+        try:
+            transferred = dns.zone.from_xfr(
+                dns.query.xfr(
+                    self.__address(),
+                    zone,
+                    port=self.port,
+                    timeout=self.timeout,
+                    keyring=self.keyring,
+                    keyname=self.keyname,
+                    keyalgorithm=self.keyalgorithm,
+                )
+            )
+        except dns.query.TransferError as e:
+            if e.rcode not in (dns.rcode.REFUSED, dns.rcode.NOTAUTH):
+                raise ProviderError(e) from e
+            # transfers aren't allowed for our key, records can only be read one by one
+            anlog.info(f"Zone transfer of {zone} refused")
+            return None
+        except (dns.exception.DNSException, OSError) as e:
+            raise ProviderError(e) from e
+        result: Dict[str, List[Dict[str, str]]] = {}
+        for name, rdataset in transferred.iterate_rdatasets():
+            rtype = dns.rdatatype.to_text(rdataset.rdtype)
+            if rtype not in RECORD_TYPES:
+                continue
+            fqdn = name.derelativize(transferred.origin).to_text(omit_final_dot=True)
+            result.setdefault(fqdn, []).extend({rtype: x.address} for x in rdataset)
+        return result
@@ -0,0 +1,76 @@
+import csv
+import json
+from dataclasses import dataclass
+from itertools import chain
+from typing import IO, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from anemoi.util import ip_version
+
+
+@dataclass
+class ImportEntry:
+    # where it came from, for error messages
+    line: int
+    domain: str
+    ip4: str = ""
+    ip6: str = ""
+
+
+# a CSV with a `domain` column and an optional `ip` column, or JSON: an array, or one
+# value per line, of {"domain": ..., "ip": ...} objects or plain domain strings
+def read_rows(fp: IO[str], fmt: str) -> Iterator[Tuple[int, Dict]]:
+    if fmt == "csv":
+        reader = csv.DictReader(fp)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    first = fp.readline()
+    if first.lstrip().startswith("["):
+        values = enumerate(json.loads(first + fp.read()), 1)
+    else:
+        lines = enumerate(chain([first], fp), 1)
+        values = ((n, json.loads(x)) for n, x in lines if x.strip())
+    for n, value in values:
+        yield n, value if isinstance(value, dict) else {"domain": value}
+
+
+# returns the entries and a list of problems. nothing should be imported unless the
+# list is empty. `zone_for` gives the configured zone of a domain, or None
+def read_entries(
+    fp: IO[str],
+    fmt: str,
+    zone_for: Callable[[str], Optional[str]],
+    existing: Set[str],
+) -> Tuple[List[ImportEntry], List[str]]:
+    entries: List[ImportEntry] = []
+    errors: List[str] = []
+    seen: Set[str] = set()
+    try:
+        for n, row in read_rows(fp, fmt):
+            domain = str(row.get("domain") or "").strip().lower().rstrip(".")
+            ip = str(row.get("ip") or "").strip()
+            if not domain:
+                errors.append(f"{n}: no domain")
+                continue
+            if not zone_for(domain):
+                errors.append(f"{n}: no zone defined for {domain}")
+                continue
+            if domain in existing:
+                errors.append(f"{n}: {domain} already has a client")
+                continue
+            if domain in seen:
+                errors.append(f"{n}: {domain} is listed more than once")
+                continue
+            entry = ImportEntry(n, domain)
+            if ip:
+                try:
+                    version = ip_version(ip)
+                except (OSError, ValueError):
+                    errors.append(f"{n}: {ip} is not an IP address")
+                    continue
+                setattr(entry, f"ip{version}", ip)
+            seen.add(domain)
+            entries.append(entry)
+    except (csv.Error, json.JSONDecodeError) as e:
+        errors.append(f"unreadable {fmt}: {e}")
+    return entries, errors
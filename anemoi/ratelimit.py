@@ -0,0 +1,81 @@
+import threading
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+from anemoi.cache import TTLCache
+
+# seconds between sweeps of idle buckets kept by a backend
+PRUNE_INTERVAL = 60
+
+# (key, rate, burst)
+Bucket = Tuple[str, float, int]
+
+
+# tokens left in a bucket that had `tokens` at `updated` and refills at `rate` per second
+def refill(tokens: float, updated: float, now: float, rate: float, burst: int) -> float:
+    return min(float(burst), tokens + max(now - updated, 0.0) * rate)
+
+
+# in-process token buckets, usable anywhere a backend's take_tokens() is. buckets that
+# haven't been touched long enough to be full again are forgotten, and the least
+# recently used ones go first if there are too many
+class TokenBuckets:
+    def __init__(self, maxsize: int = 65536):
+        self.buckets = TTLCache(ttl=3600, maxsize=maxsize)
+        self.lock = threading.Lock()
+
+    def take_tokens(self, buckets: List[Bucket]) -> bool:
+        now = time()
+        with self.lock:
+            levels = []
+            for key, rate, burst in buckets:
+                tokens, updated = self.buckets.get(key, (float(burst), now))
+                levels.append(refill(tokens, updated, now, rate, burst))
+            allowed = all(tokens >= 1 for tokens in levels)
+            for (key, rate, burst), tokens in zip(buckets, levels):
+                self.buckets.set(
+                    key,
+                    (tokens - 1 if allowed else tokens, now),
+                    ttl=burst / rate if rate else None,
+                )
+        return allowed
+
+
+# token bucket limits per uuid and per client address, checked before any bcrypt or
+# backend work is done for a check-in
+class RateLimiter:
+    limits: Dict[str, Tuple[float, int]]
+
+    def __init__(self, config: Dict, backend=None):
+        self.limits = {
+            kind: (limit["rate"], limit.get("burst", 1))
+            for kind in ("uuid", "ip")
+            if (limit := config.get(kind))
+        }
+        # the backend can share buckets between worker processes
+        self.store = backend if config.get("storage") == "backend" else TokenBuckets()
+        # a bucket left alone this long is full again, the same as one that was never
+        # made, so the backend can drop it. otherwise every made-up uuid or address
+        # that checks in would keep a row
+        self.idle = max(
+            (burst / rate for rate, burst in self.limits.values()), default=0
+        )
+        self.next_prune = 0.0
+
+    def __prune(self):
+        now = time()
+        if isinstance(self.store, TokenBuckets) or now < self.next_prune:
+            return
+        self.next_prune = now + PRUNE_INTERVAL
+        self.store.prune_tokens(now - self.idle)
+
+    # a token is only taken if every bucket has one, so a client that is over its
+    # own limit doesn't use up the tokens of everyone else behind the same address
+    def allow(self, uuid: Optional[str], ip: Optional[str]) -> bool:
+        self.__prune()
+        buckets = [
+            (f"{kind}:{key}", *limit)
+            for kind, key in (("ip", ip), ("uuid", uuid))
+            if key and (limit := self.limits.get(kind))
+        ]
+        return not buckets or self.store.take_tokens(buckets)
@@ -0,0 +1,134 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from anemoi.backends import Backend
+from anemoi.client import Client
+from anemoi.providers import ProviderError, Providers
+from anemoi.updates import UpdateQueue
+from anemoi.util import anlog
+
+
+@dataclass
+class Fix:
+    zone: str
+    domain: str
+    rtype: str
+    # what the backend last saw, and what the provider has now
+    ip: str
+    current: List[str]
+    client: Optional[Client] = None
+
+
+# compares every client's last known IPs with its provider's records and pushes the
+# ones that drifted. each zone is listed once instead of reading every client's
+# records, and zones are worked on in parallel, at most `parallelism` at a time
+class Reconciler:
+    backend: Backend
+    providers: Providers
+    updates: Optional[UpdateQueue]
+
+    def __init__(
+        self,
+        backend: Backend,
+        providers: Providers,
+        parallelism: int = 4,
+        updates: Optional[UpdateQueue] = None,
+    ):
+        self.backend = backend
+        self.providers = providers
+        self.parallelism = max(parallelism, 1)
+        # when given, fixes are queued so they are coalesced and damped like check-ins
+        self.updates = updates
+
+    def __clients_by_zone(self) -> Dict[str, List[Client]]:
+        zones: Dict[str, List[Client]] = {}
+        self.backend.connect()
+        try:
+            for client in self.backend.iter_clients():
+                zone = self.providers.get_zone(client.domain)
+                zones.setdefault(zone, []).append(client)
+        finally:
+            self.backend.close()
+        return zones
+
+    def __zone_fixes(self, zone: str, clients: List[Client]) -> List[Fix]:
+        if not (provider := self.providers.get_provider(zone)):
+            anlog.error(f"No provider for {zone}, skipping {len(clients)} clients")
+            return []
+        # a failed listing is skipped rather than taken as a zone without records,
+        # which would have every client's record created again
+        try:
+            listing = provider.get_zone_record_ips(zone)
+        except ProviderError as e:
+            anlog.error(f"Could not list {zone}, skipping {len(clients)} clients: {e}")
+            return []
+        if listing is None:
+            anlog.info(f"{zone} can't be listed at once, reading records one by one")
+        fixes = []
+        for client in clients:
+            if listing is not None:
+                records = listing.get(client.domain, [])
+            else:
+                try:
+                    records = provider.get_record_ips(client.domain)
+                except ProviderError as e:
+                    anlog.error(f"Could not look up {client.domain}, skipping: {e}")
+                    continue
+            for ip, rtype in ((client.last_ip4, "A"), (client.last_ip6, "AAAA")):
+                current = [x[rtype] for x in records if rtype in x]
+                if ip and current != [ip]:
+                    fixes.append(Fix(zone, client.domain, rtype, ip, current, client))
+        return fixes
+
+    def plan(self) -> List[Fix]:
+        zones = self.__clients_by_zone()
+        with ThreadPoolExecutor(self.parallelism) as pool:
+            results = pool.map(lambda x: self.__zone_fixes(*x), zones.items())
+            return [fix for fixes in results for fix in fixes]
+
+    # a zone's fixes go to the provider together, in one call where it takes batches
+    def __push_zone(self, fixes: List[Fix]) -> Tuple[int, int]:
+        if self.updates:
+            for fix in fixes:
+                self.updates.enqueue(fix.domain, fix.ip, fix.rtype, client=fix.client)
+            return len(fixes), 0
+        provider = self.providers.get_provider(fixes[0].zone)
+        results = provider.update_record_ips(
+            fixes[0].zone, [(x.domain, x.rtype, x.ip) for x in fixes]
+        )
+        for fix, ok in zip(fixes, results):
+            if not ok:
+                anlog.error(f"error updating IP for {fix.domain}")
+        return results.count(True), results.count(False)
+
+    # returns (pushed, failed), where queued fixes count as pushed
+    def apply(self, fixes: List[Fix]) -> Tuple[int, int]:
+        by_zone: Dict[str, List[Fix]] = {}
+        for fix in fixes:
+            by_zone.setdefault(fix.zone, []).append(fix)
+        with ThreadPoolExecutor(self.parallelism) as pool:
+            results = list(pool.map(self.__push_zone, by_zone.values()))
+        return sum(x[0] for x in results), sum(x[1] for x in results)
+
+    def run(self) -> Tuple[List[Fix], int, int]:
+        fixes = self.plan()
+        pushed, failed = self.apply(fixes)
+        if fixes:
+            anlog.info(f"Reconciled {pushed} drifted records, {failed} failed")
+        return fixes, pushed, failed
+
+    # reconcile every `interval` seconds from a background thread
+    def start(self, interval: float) -> threading.Event:
+        stopped = threading.Event()
+
+        def loop():
+            while not stopped.wait(interval):
+                try:
+                    self.run()
+                except Exception as e:
+                    anlog.error(e)
+
+        threading.Thread(target=loop, name="anemoi-reconcile", daemon=True).start()
+        return stopped
@@ -0,0 +1,106 @@
+import os
+import signal
+import threading
+from typing import Any, Dict, MutableMapping, Optional
+
+from jsonschema import ValidationError
+
+from anemoi.context import zone_damping
+from anemoi.providers import Providers
+from anemoi.util import anlog, get_or_parse_yaml
+
+# config sections that take effect on reload. everything else is read once at startup
+RELOADED = ("domains",)
+# cache settings that belong to the providers, the rest are the credential cache's
+RELOADED_CACHE = ("record_ttl", "record_size")
+
+
+# re-reads the config file on SIGHUP, and every `interval` seconds if it changed, and
+# swaps in providers for it. a zone's provider is only built again when its config
+# changed. requests that already got the old Providers keep using it, new ones get the
+# new one, since every swap is a single assignment
+class ConfigReloader:
+    context: MutableMapping[str, Any]
+
+    def __init__(
+        self, path: str, context: MutableMapping[str, Any], interval: float = 0
+    ):
+        self.path = path
+        self.context = context
+        self.interval = interval
+        self.requested = threading.Event()
+        self.mtime = self.__mtime()
+
+    def __mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def __warn_unreloaded(self, old: Dict, new: Dict):
+        for key in sorted(set(old) | set(new)):
+            if key in RELOADED:
+                continue
+            before, after = old.get(key, {}), new.get(key, {})
+            if key == "cache":
+                before = {k: v for k, v in before.items() if k not in RELOADED_CACHE}
+                after = {k: v for k, v in after.items() if k not in RELOADED_CACHE}
+            if before != after:
+                anlog.warning(f"{key} changed in {self.path}, restart to apply it")
+
+    # returns whether the new config was applied. a config that doesn't parse or
+    # validate is logged and the running one is kept
+    def reload(self) -> bool:
+        self.mtime = self.__mtime()
+        try:
+            config = get_or_parse_yaml(self.path)
+            old: Providers = self.context["anemoi.providers"]
+            providers = Providers(config, previous=old)
+        except ValidationError as e:
+            anlog.error(f"Not reloading {self.path}, it failed validation: {e.message}")
+            return False
+        except Exception as e:
+            anlog.error(f"Not reloading {self.path}: {e}")
+            return False
+        self.__warn_unreloaded(self.context["anemoi.config"], config)
+        if updates := self.context.get("anemoi.updates"):
+            updates.zone_damping = zone_damping(config)
+            updates.providers = providers
+        if reconciler := self.context.get("anemoi.reconciler"):
+            reconciler.providers = providers
+        self.context["anemoi.providers"] = providers
+        self.context["anemoi.config"] = config
+        kept = len(providers.providers)
+        anlog.info(
+            f"Reloaded {self.path}: {len(providers.configs)} zones, {kept} providers kept"
+        )
+        return True
+
+    def __watch(self):
+        while True:
+            self.requested.wait(self.interval or None)
+            changed = self.interval and self.__mtime() != self.mtime
+            if self.requested.is_set() or changed:
+                self.requested.clear()
+                self.reload()
+
+    def start(self):
+        # the signal handler only asks for a reload. the reload runs on the watch
+        # thread, so it never interrupts a request that holds a lock
+        if hasattr(signal, "SIGHUP") and (
+            threading.current_thread() is threading.main_thread()
+        ):
+            signal.signal(signal.SIGHUP, lambda *_: self.requested.set())
+        threading.Thread(target=self.__watch, name="anemoi-reload", daemon=True).start()
+
+
+# only a config that came from a file can be reloaded
+def watch_config(config_file, context: MutableMapping[str, Any]):
+    if not isinstance(config_file, str):
+        return
+    reload_config = context["anemoi.config"].get("reload", {})
+    reloader = ConfigReloader(
+        config_file, context, interval=reload_config.get("interval", 0)
+    )
+    reloader.start()
+    context["anemoi.reloader"] = reloader
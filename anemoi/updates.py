@@ -0,0 +1,251 @@
+import threading
+from dataclasses import dataclass
+from time import monotonic, time
+from typing import Dict, List, Optional, Tuple
+
+from anemoi.backends import Backend
+from anemoi.client import Client
+from anemoi.providers import Providers
+from anemoi.util import anlog
+
+
+@dataclass
+class PendingUpdate:
+    domain: str
+    rtype: str
+    ip: str
+    queued: float
+    # not pushed before this time, see damping
+    due: float = 0.0
+    # whose record this is, to mark it synced in the backend once pushed
+    client: Optional[Client] = None
+
+
+# pushes record updates to providers from a pool of background threads so check-ins
+# don't have to wait on them. updates are coalesced per (domain, rtype), so if a
+# client changes IP again before its update goes out, only the newest IP is pushed.
+#
+# for providers that can update many records in one call, a worker takes every due
+# update in the same zone at once, up to batch_size, and pushes them together
+#
+# damping sets a minimum number of seconds between pushes for the same record. updates
+# that arrive inside that window wait in the queue until it closes, so a client
+# flapping between IPs costs one provider call per window instead of one per change
+class UpdateQueue:
+    providers: Providers
+    pending: Dict[Tuple[str, str], PendingUpdate]
+    # the IP being pushed, by record
+    in_flight: Dict[Tuple[str, str], str]
+    last_push: Dict[Tuple[str, str], float]
+    suppressed_by_domain: Dict[str, int]
+
+    def __init__(
+        self,
+        providers: Providers,
+        workers: int = 4,
+        asynchronous: bool = True,
+        damping: float = 0,
+        zone_damping: Optional[Dict[str, float]] = None,
+        batch_size: int = 100,
+        backend: Optional[Backend] = None,
+    ):
+        self.providers = providers
+        # when given, pushed records are marked synced for the clients they belong to
+        self.backend = backend
+        self.batch_size = max(batch_size, 1)
+        # when False, the queue only holds back updates that are being damped
+        self.asynchronous = asynchronous
+        self.damping = damping
+        self.zone_damping = zone_damping or {}
+        self.pending = {}
+        self.in_flight = {}
+        self.last_push = {}
+        self.suppressed_by_domain = {}
+        self.pushed = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.suppressed = 0
+        self.cond = threading.Condition()
+        for i in range(max(workers, 1)):
+            threading.Thread(
+                target=self._work, name=f"anemoi-updates-{i}", daemon=True
+            ).start()
+
+    def damping_for(self, domain: str) -> float:
+        return self.zone_damping.get(self.providers.get_zone(domain), self.damping)
+
+    # seconds until this record may be pushed again, 0 if it can be pushed now
+    def holdoff(self, domain: str, rtype: str) -> float:
+        if not (interval := self.damping_for(domain)):
+            return 0.0
+        with self.cond:
+            last = self.last_push.get((domain, rtype))
+        if last is None:
+            return 0.0
+        return max(last + interval - monotonic(), 0.0)
+
+    # whether an update for this record has to go through the queue right now
+    def defers(self, domain: str, rtype: str) -> bool:
+        return self.asynchronous or bool(self.holdoff(domain, rtype))
+
+    # the IP this record is still going to be set to, if an update for it is waiting or
+    # being pushed. a check-in for another IP has to be queued behind it even when the
+    # provider already has that IP, or the older update would overwrite it
+    def waiting_ip(self, domain: str, rtype: str) -> Optional[str]:
+        with self.cond:
+            if update := self.pending.get((domain, rtype)):
+                return update.ip
+            return self.in_flight.get((domain, rtype))
+
+    # for updates that were pushed without going through the queue
+    def mark_pushed(self, domain: str, rtype: str):
+        if self.damping_for(domain):
+            with self.cond:
+                self.last_push[(domain, rtype)] = monotonic()
+
+    def enqueue(
+        self, domain: str, ip: str, rtype: str, client: Optional[Client] = None
+    ):
+        delay = self.holdoff(domain, rtype)
+        now = monotonic()
+        with self.cond:
+            if update := self.pending.get((domain, rtype)):
+                update.ip = ip
+                update.client = client or update.client
+                self.coalesced += 1
+            else:
+                update = PendingUpdate(domain, rtype, ip, now, now + delay, client)
+                self.pending[(domain, rtype)] = update
+            if update.due > now:
+                self.suppressed += 1
+                self.suppressed_by_domain[domain] = (
+                    self.suppressed_by_domain.get(domain, 0) + 1
+                )
+                anlog.info(
+                    f"damping update for {domain} to {ip}, pushing in {update.due - now:.0f}s"
+                )
+            self.cond.notify()
+
+    # rebuild the queue from what the backend last saw, for updates that were
+    # still pending when the server went down. like a reconcile, each zone is listed
+    # once and only the records that differ from it are queued
+    def restore(self, backend: Backend):
+        from anemoi.reconcile import Reconciler
+
+        fixes = Reconciler(backend, self.providers).plan()
+        for fix in fixes:
+            self.enqueue(fix.domain, fix.ip, fix.rtype, client=fix.client)
+        anlog.info(f"Restored {len(fixes)} pending record updates")
+
+    def stats(self) -> Dict:
+        with self.cond:
+            oldest = min((x.queued for x in self.pending.values()), default=None)
+            return {
+                "depth": len(self.pending),
+                "in_flight": len(self.in_flight),
+                "lag": monotonic() - oldest if oldest is not None else 0.0,
+                "pushed": self.pushed,
+                "failed": self.failed,
+                "coalesced": self.coalesced,
+                "suppressed": self.suppressed,
+                "suppressed_by_domain": dict(self.suppressed_by_domain),
+            }
+
+    def __claim(self, key: Tuple[str, str], now: float) -> PendingUpdate:
+        if self.damping_for(key[0]):
+            self.last_push[key] = now
+        update = self.pending.pop(key)
+        self.in_flight[key] = update.ip
+        return update
+
+    # hand out the oldest due update whose record isn't already being pushed, along
+    # with the other due updates in its zone if its provider takes batches
+    def _take(self) -> List[PendingUpdate]:
+        with self.cond:
+            while True:
+                now = monotonic()
+                next_due = None
+                for key, update in self.pending.items():
+                    if key in self.in_flight:
+                        continue
+                    if update.due <= now:
+                        return self.__claim_batch(key, now)
+                    next_due = min(next_due or update.due, update.due)
+                self.cond.wait(next_due - now if next_due else None)
+
+    def __claim_batch(self, first: Tuple[str, str], now: float) -> List[PendingUpdate]:
+        batch = [self.__claim(first, now)]
+        provider = self.providers.get_provider(first[0])
+        if self.batch_size == 1 or not (provider and provider.batches):
+            return batch
+        zone = self.providers.get_zone(first[0])
+        for key, update in list(self.pending.items()):
+            if len(batch) >= self.batch_size:
+                break
+            if (
+                key not in self.in_flight
+                and update.due <= now
+                and self.providers.get_zone(key[0]) == zone
+            ):
+                batch.append(self.__claim(key, now))
+        return batch
+
+    # returns whether each update in the batch made it to the provider. batched records
+    # aren't read back first, check-ins already compared them before queueing
+    def _push_batch(self, batch: List[PendingUpdate]) -> List[bool]:
+        if len(batch) == 1:
+            return [self._push(batch[0])]
+        # the same Providers for both, even if a config reload swaps it in between
+        providers = self.providers
+        zone = providers.get_zone(batch[0].domain)
+        provider = providers.get_provider(batch[0].domain)
+        return provider.update_record_ips(
+            zone, [(x.domain, x.rtype, x.ip) for x in batch]
+        )
+
+    def _push(self, update: PendingUpdate) -> bool:
+        provider = self.providers.get_provider(update.domain)
+        if not provider:
+            anlog.error(f"No provider for {update.domain}")
+            return False
+        current = provider.get_record_ips(update.domain, rtype=update.rtype)
+        if [{update.rtype: update.ip}] == current:
+            return True
+        return provider.update_record_ip(update.domain, update.ip, rtype=update.rtype)
+
+    def _work(self):
+        while True:
+            batch = self._take()
+            try:
+                results = self._push_batch(batch)
+            except Exception as e:
+                anlog.error(e)
+                results = [False] * len(batch)
+            with self.cond:
+                for update, ok in zip(batch, results):
+                    self.in_flight.pop((update.domain, update.rtype), None)
+                    if ok:
+                        self.pushed += 1
+                    else:
+                        self.failed += 1
+                self.cond.notify_all()
+            for update, ok in zip(batch, results):
+                if ok:
+                    anlog.debug(f"changed IP for {update.domain} to {update.ip}")
+                else:
+                    anlog.error(f"error updating IP for {update.domain}")
+            self.__mark_synced([x for x, ok in zip(batch, results) if ok])
+
+    def __mark_synced(self, pushed: List[PendingUpdate]):
+        if not self.backend or not (pushed := [x for x in pushed if x.client]):
+            return
+        self.backend.connect()
+        try:
+            now = time()
+            for update in pushed:
+                version = 4 if update.rtype == "A" else 6
+                self.backend.mark_synced(update.client, update.ip, version, now)
+        except Exception as e:
+            anlog.error(e)
+        finally:
+            self.backend.close()
@@ -1,13 +1,18 @@
+import ipaddress
 import json
 import logging
 import socket
-from typing import Dict, Optional, Union
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from time import monotonic
+from typing import Dict, List, Optional, Union
 
 import bcrypt
-import requests
 import yaml
 from jsonschema import validate
 
+from anemoi.cache import TTLCache
+
 anlog = logging.getLogger("anlog")
 
 
@@ -35,11 +40,79 @@ def limit_dict(dictionary, keys: tuple, translation: Optional[tuple] = None) ->
     return result
 
 
-def get_my_public_ip():
-    r = requests.get("https://ipinfo.io/ip")
-    if r.status_code == 200:
-        return r.text.strip()
-    return None
+PUBLIC_IP_SOURCES = {
+    4: ["https://api.ipify.org", "https://ipv4.icanhazip.com", "https://ipinfo.io/ip"],
+    6: ["https://api6.ipify.org", "https://ipv6.icanhazip.com"],
+}
+
+
+# finds this machine's public IP by asking every source at once and taking the first
+# valid answer, all within `timeout` seconds. answers are cached per IP version
+class PublicIP:
+    def __init__(
+        self,
+        sources: Optional[Dict[int, List[str]]] = None,
+        ttl: float = 300,
+        timeout: float = 3,
+    ):
+        self.sources = PUBLIC_IP_SOURCES | (sources or {})
+        self.timeout = timeout
+        self.cache = TTLCache(ttl, maxsize=2)
+        self.locks = {4: threading.Lock(), 6: threading.Lock()}
+        self.pool = ThreadPoolExecutor(
+            max(len(x) for x in self.sources.values()) * 2,
+            thread_name_prefix="anemoi-public-ip",
+        )
+
+    def __ask(self, url: str, version: int, deadline: float) -> Optional[str]:
+        # only the server looks up its own IP, client commands don't load requests
+        import requests
+
+        r = requests.get(url, timeout=max(deadline - monotonic(), 0.1))
+        answer = r.text.strip() if r.status_code == 200 else ""
+        try:
+            if ipaddress.ip_address(answer).version == version:
+                return answer
+        except ValueError:
+            pass
+        raise ValueError(f"{url} did not return an IPv{version} address")
+
+    def get(self, version: int = 4) -> Optional[str]:
+        if ip := self.cache.get(version):
+            return ip
+        # only one lookup per version at a time, the rest wait for its answer
+        with self.locks[version]:
+            if ip := self.cache.get(version):
+                return ip
+            deadline = monotonic() + self.timeout
+            futures = [
+                self.pool.submit(self.__ask, url, version, deadline)
+                for url in self.sources.get(version, [])
+            ]
+            try:
+                for future in as_completed(futures, timeout=self.timeout):
+                    if not future.exception():
+                        ip = future.result()
+                        break
+            except TimeoutError:
+                pass
+            for future in futures:
+                future.cancel()
+            if not ip:
+                anlog.error(f"Could not find public IPv{version} address")
+                return None
+            self.cache.set(version, ip)
+            return ip
+
+
+_public_ip: Optional[PublicIP] = None
+
+
+def get_my_public_ip(version: int = 4) -> Optional[str]:
+    global _public_ip
+    if _public_ip is None:
+        _public_ip = PublicIP()
+    return _public_ip.get(version)
 
 
 def hash_password(passwd):
@@ -56,6 +129,13 @@ def is_ip_record_valid(ip: str, rtype: str):
     return True
 
 
+def is_loopback(ip: Optional[str]) -> bool:
+    try:
+        return ipaddress.ip_address(ip).is_loopback
+    except ValueError:
+        return False
+
+
 def ip_version(ip: str) -> int:
     try:
         socket.inet_aton(ip)
@@ -69,6 +149,15 @@ def record_type(ip: str):
     return "AAAA" if ip_version(ip) == 6 else "A"
 
 
+# pick the IP of type rtype out of a list of {'A': '1.1.1.1'} objects, "" if there is none
+def record_ip(ips: List[Dict[str, str]], rtype: str) -> str:
+    record = ""
+    for i in ips:
+        if rtype in i:  # noqa: SIM908
+            record = i[rtype]
+    return record
+
+
 config_schema = """
 {
     "type": "object",
@@ -105,12 +194,158 @@ config_schema = """
                 },
                 "path": {
                     "type": "string"
+                },
+                "max_connections": {
+                    "type": "integer",
+                    "minimum": 1
+                },
+                "stale_timeout": {
+                    "type": "number"
+                },
+                "flush_size": {
+                    "type": "integer",
+                    "minimum": 1
+                },
+                "flush_interval": {
+                    "type": "number"
+                },
+                "compact_size": {
+                    "type": "integer",
+                    "minimum": 1
                 }
             },
             "required": [
                 "path",
                 "type"
             ]
+        },
+        "cache": {
+            "type": "object",
+            "additionalProperties": false,
+            "properties": {
+                "credential_ttl": {
+                    "type": "number"
+                },
+                "credential_size": {
+                    "type": "integer"
+                },
+                "unknown_client_ttl": {
+                    "type": "number"
+                },
+                "unknown_client_size": {
+                    "type": "integer"
+                },
+                "record_ttl": {
+                    "type": "number"
+                },
+                "record_size": {
+                    "type": "integer"
+                },
+                "synced_ttl": {
+                    "type": "number",
+                    "minimum": 0
+                }
+            }
+        },
+        "updates": {
+            "type": "object",
+            "additionalProperties": false,
+            "properties": {
+                "mode": {
+                    "type": "string",
+                    "enum": ["sync", "async"]
+                },
+                "workers": {
+                    "type": "integer",
+                    "minimum": 1
+                },
+                "restore": {
+                    "type": "boolean"
+                },
+                "damping": {
+                    "type": "number",
+                    "minimum": 0
+                },
+                "batch_size": {
+                    "type": "integer",
+                    "minimum": 1
+                }
+            }
+        },
+        "ratelimit": {
+            "type": "object",
+            "additionalProperties": false,
+            "properties": {
+                "uuid": {"$ref": "#/$defs/bucket"},
+                "ip": {"$ref": "#/$defs/bucket"},
+                "storage": {
+                    "type": "string",
+                    "enum": ["memory", "backend"]
+                }
+            }
+        },
+        "reload": {
+            "type": "object",
+            "additionalProperties": false,
+            "properties": {
+                "interval": {
+                    "type": "number",
+                    "minimum": 0
+                }
+            }
+        },
+        "reconcile": {
+            "type": "object",
+            "additionalProperties": false,
+            "properties": {
+                "interval": {
+                    "type": "number",
+                    "exclusiveMinimum": 0
+                },
+                "parallelism": {
+                    "type": "integer",
+                    "minimum": 1
+                }
+            }
+        },
+        "public_ip": {
+            "type": "object",
+            "additionalProperties": false,
+            "properties": {
+                "ipv4_sources": {
+                    "type": "array",
+                    "items": {"type": "string"}
+                },
+                "ipv6_sources": {
+                    "type": "array",
+                    "items": {"type": "string"}
+                },
+                "ttl": {
+                    "type": "number",
+                    "minimum": 0
+                },
+                "timeout": {
+                    "type": "number",
+                    "exclusiveMinimum": 0
+                }
+            }
+        }
+    },
+    "$defs": {
+        "bucket": {
+            "type": "object",
+            "additionalProperties": false,
+            "properties": {
+                "rate": {
+                    "type": "number",
+                    "exclusiveMinimum": 0
+                },
+                "burst": {
+                    "type": "integer",
+                    "minimum": 1
+                }
+            },
+            "required": ["rate"]
         }
     },
     "required": [
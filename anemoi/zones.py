@@ -0,0 +1,37 @@
+from typing import Dict, Iterable, List, Optional
+
+
+# configured zones stored label by label from the right, so finding the zone a domain
+# belongs to is one step per label of the domain, however many zones there are. the
+# longest match wins, so a delegated sub.example.com is found before example.com, and
+# only whole labels match: evilexample.com is not in example.com
+class ZoneTrie:
+    root: Dict
+
+    def __init__(self, zones: Iterable[str] = ()):
+        self.root = {}
+        for zone in zones:
+            self.add(zone)
+
+    @staticmethod
+    def labels(name: str) -> List[str]:
+        return name.lower().rstrip(".").split(".")[::-1]
+
+    def add(self, zone: str):
+        node = self.root
+        for label in self.labels(zone):
+            node = node.setdefault(label, {})
+        # None never clashes with a label, it marks where a zone ends
+        node[None] = zone
+
+    # returns the zone as it was added, or None if the domain isn't in any zone
+    def match(self, domain: str) -> Optional[str]:
+        node, found = self.root, None
+        for label in self.labels(domain):
+            if (node := node.get(label)) is None:
+                break
+            found = node.get(None, found)
+        return found
+
+    def __contains__(self, domain: str) -> bool:
+        return self.match(domain) is not None
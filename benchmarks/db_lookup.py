@@ -0,0 +1,97 @@
+# lookup latency of the database backend against table size, on the old
+# index-less schema and again after DatabaseBackend has migrated it
+#
+#   python -m benchmarks.db_lookup --sizes 1000 10000 50000
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+from statistics import median
+from time import perf_counter
+from uuid import uuid4
+
+from peewee import SqliteDatabase
+
+from anemoi.backends.database import ClientModel, DatabaseBackend, db_proxy
+
+LEGACY_SCHEMA = """
+CREATE TABLE "clientmodel" (
+    "id" INTEGER NOT NULL PRIMARY KEY,
+    "domain" VARCHAR(253) NOT NULL,
+    "uuid" VARCHAR(36) NOT NULL,
+    "secret_key" VARCHAR(255) NOT NULL,
+    "last_ip4" VARCHAR(15) NOT NULL,
+    "last_ip6" VARCHAR(45) NOT NULL
+)
+"""
+# the old table only has these, columns added since would fail the query
+LEGACY_COLUMNS = (
+    ClientModel.domain,
+    ClientModel.uuid,
+    ClientModel.secret_key,
+    ClientModel.last_ip4,
+    ClientModel.last_ip6,
+)
+
+
+def seed(path: str, size: int) -> list:
+    uuids = [str(uuid4()) for _ in range(size)]
+    conn = sqlite3.connect(path)
+    conn.execute(LEGACY_SCHEMA)
+    conn.executemany(
+        'INSERT INTO "clientmodel" (domain, uuid, secret_key, last_ip4, last_ip6) VALUES (?, ?, ?, ?, ?)',
+        (
+            (f"client{i}.example.com", u, "x" * 60, "192.0.2.1", "")
+            for i, u in enumerate(uuids)
+        ),
+    )
+    conn.commit()
+    conn.close()
+    return uuids
+
+
+def time_lookups(lookup, uuids: list, count: int) -> float:
+    samples = []
+    for uuid in random.sample(uuids, min(count, len(uuids))):
+        start = perf_counter()
+        lookup(uuid)
+        samples.append(perf_counter() - start)
+    return median(samples) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="database backend lookup latency by table size"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--lookups", type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{'clients':>10} {'before (us)':>12} {'after (us)':>12}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.db")
+            uuids = seed(path, size)
+
+            # old schema: bind the models without running any migrations
+            db = SqliteDatabase(path)
+            db_proxy.initialize(db)
+            legacy = ClientModel.select(*LEGACY_COLUMNS).tuples()
+            before = time_lookups(
+                lambda u: legacy.where(ClientModel.uuid == u).first(),
+                uuids,
+                args.lookups,
+            )
+            db.close()
+
+            backend = DatabaseBackend({"vendor": "sqlite", "path": path})
+            after = time_lookups(
+                lambda u: backend.get_client(uuid=u), uuids, args.lookups
+            )
+            backend.db.close()
+        print(f"{size:>10} {before:>12.1f} {after:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+# local stand-ins for the parts of the Cloudflare and Porkbun APIs that anemoi uses,
+# so benchmarks can run offline. records are kept in memory in a FakeDNS, and every
+# request can be slowed down and/or failed on purpose
+#
+#   python -m benchmarks.fake_apis --provider cloudflare --port 8053 --latency 0.05
+import argparse
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+ZONE_ID = "0" * 32
+
+
+class FakeDNS:
+    records: Dict[str, Dict]
+
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+        self.next_id = 1
+        # requests served, and how many of them were failed on purpose
+        self.calls = 0
+        self.errors = 0
+
+    def add(self, name: str, rtype: str, content: str) -> Dict:
+        with self.lock:
+            record = {
+                "id": f"{self.next_id:032x}",
+                "name": name,
+                "type": rtype,
+                "content": content,
+                "ttl": 600,
+                "proxied": False,
+            }
+            self.next_id += 1
+            self.records[record["id"]] = record
+            return dict(record)
+
+    def find(
+        self,
+        name: Optional[str] = None,
+        rtype: Optional[str] = None,
+        zone: Optional[str] = None,
+    ) -> List[Dict]:
+        with self.lock:
+            return [
+                dict(x)
+                for x in self.records.values()
+                if (name is None or x["name"] == name)
+                and (rtype is None or x["type"] == rtype)
+                and (
+                    zone is None or x["name"] == zone or x["name"].endswith(f".{zone}")
+                )
+            ]
+
+    def update(self, record_id: str, content: str) -> Optional[Dict]:
+        with self.lock:
+            if record := self.records.get(record_id):
+                record["content"] = content
+                return dict(record)
+            return None
+
+    def delete(self, name: str, rtype: Optional[str] = None):
+        with self.lock:
+            for record in list(self.records.values()):
+                if record["name"] == name and rtype in (None, record["type"]):
+                    del self.records[record["id"]]
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls = 0
+            self.errors = 0
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    # keep connections open like the real APIs do
+    protocol_version = "HTTP/1.1"
+    server: "FakeAPIServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def route(self, method: str, path: List[str], query: Dict, body: Dict) -> Tuple:
+        return 404, {}
+
+    def error(self) -> Tuple:
+        return 500, {}
+
+    def __handle(self, method: str):
+        dns = self.server.dns
+        length = int(self.headers.get("content-length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            body = {}
+        url = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if self.server.latency:
+            sleep(self.server.latency)
+        failed = random.random() < self.server.error_rate
+        with dns.lock:
+            dns.calls += 1
+            dns.errors += failed
+        if failed:
+            status, payload = self.error()
+        else:
+            path = [x for x in url.path.split("/") if x]
+            status, payload = self.route(method, path, query, body)
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.__handle("GET")
+
+    def do_POST(self):
+        self.__handle("POST")
+
+    def do_PATCH(self):
+        self.__handle("PATCH")
+
+
+# /client/v4/zones and /client/v4/zones/<id>/dns_records[/<id>|/batch], with the
+# single zone the server was started for
+class CloudflareHandler(FakeAPIHandler):
+    @staticmethod
+    def result(result, status: int = 200, **extra) -> Tuple:
+        return status, {
+            "success": True,
+            "errors": [],
+            "messages": [],
+            "result": result,
+            **extra,
+        }
+
+    # one page of results, the SDK keeps asking for the next until it gets none
+    def page(self, results: List, query: Dict) -> Tuple:
+        page = int(query.get("page", 1))
+        per_page = int(query.get("per_page", 100))
+        start, end = (page - 1) * per_page, page * per_page
+        items = results[start:end]
+        return self.result(
+            items,
+            result_info={
+                "page": page,
+                "per_page": per_page,
+                "count": len(items),
+                "total_count": len(results),
+                "total_pages": -(-len(results) // per_page),
+            },
+        )
+
+    def error(self) -> Tuple:
+        return 500, {
+            "success": False,
+            "errors": [{"code": 10000, "message": "injected error"}],
+            "messages": [],
+            "result": None,
+        }
+
+    def route(self, method: str, path: List[str], query: Dict, body: Dict) -> Tuple:
+        dns, zone = self.server.dns, self.server.zone
+        path = path[2:] if path[:2] == ["client", "v4"] else path
+        if method == "GET" and path == ["zones"]:
+            zones = []
+            if query.get("name", zone) == zone:
+                zones = [{"id": ZONE_ID, "name": zone, "status": "active"}]
+            return self.page(zones, query)
+        if len(path) < 3 or path[:3] != ["zones", ZONE_ID, "dns_records"]:
+            return 404, {"success": False, "errors": [], "messages": []}
+        if method == "GET" and len(path) == 3:
+            records = dns.find(query.get("name"), query.get("type"), zone)
+            return self.page(records, query)
+        if method == "POST" and len(path) == 3:
+            return self.result(dns.add(body["name"], body["type"], body["content"]))
+        if method == "POST" and path[3:] == ["batch"]:
+            # all or nothing, like the real one
+            ids = {x["id"] for x in dns.find(zone=zone)}
+            if any(x["id"] not in ids for x in body.get("patches", [])):
+                return 400, {
+                    "success": False,
+                    "errors": [{"code": 81044, "message": "Record does not exist."}],
+                    "messages": [],
+                }
+            patches = [
+                dns.update(x["id"], x["content"]) for x in body.get("patches", [])
+            ]
+            posts = [
+                dns.add(x["name"], x["type"], x["content"])
+                for x in body.get("posts", [])
+            ]
+            return self.result({"patches": patches, "posts": posts})
+        if method == "PATCH" and len(path) == 4:
+            if record := dns.update(path[3], body["content"]):
+                return self.result(record)
+        return 404, {
+            "success": False,
+            "errors": [{"code": 81044, "message": "Record does not exist."}],
+            "messages": [],
+        }
+
+
+# POST /api/json/v3/dns/<command>/<domain>/...
+class PorkbunHandler(FakeAPIHandler):
+    def error(self) -> Tuple:
+        return 500, {"status": "ERROR", "message": "injected error"}
+
+    def route(self, method: str, path: List[str], query: Dict, body: Dict) -> Tuple:
+        dns = self.server.dns
+        path = path[3:] if path[:3] == ["api", "json", "v3"] else path
+        if method != "POST" or len(path) < 3 or path[0] != "dns":
+            return 404, {"status": "ERROR", "message": "Invalid command."}
+        command, domain, rest = path[1], path[2], path[3:]
+        name = ".".join([*rest[1:2], domain])
+        if command == "retrieve":
+            return 200, {"status": "SUCCESS", "records": dns.find(zone=domain)}
+        if command == "retrieveByNameType" and rest:
+            return 200, {"status": "SUCCESS", "records": dns.find(name, rest[0])}
+        if command == "create":
+            sub = body.get("name")
+            full = f"{sub}.{domain}" if sub else domain
+            record = dns.add(full, body.get("type", "A"), body.get("content", ""))
+            return 200, {"status": "SUCCESS", "id": record["id"]}
+        if command == "editByNameType" and rest:
+            for record in dns.find(name, rest[0]):
+                dns.update(record["id"], body.get("content", ""))
+            return 200, {"status": "SUCCESS"}
+        return 400, {"status": "ERROR", "message": "Invalid command."}
+
+
+HANDLERS = {"cloudflare": CloudflareHandler, "porkbun": PorkbunHandler}
+
+
+class FakeAPIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        provider: str,
+        dns: FakeDNS,
+        zone: str,
+        port: int = 0,
+        latency: float = 0,
+        error_rate: float = 0,
+    ):
+        super().__init__(("127.0.0.1", port), HANDLERS[provider])
+        self.provider = provider
+        self.dns = dns
+        self.zone = zone
+        self.latency = latency
+        self.error_rate = error_rate
+
+    # what to set as base_url/uri in the provider's config
+    @property
+    def url(self) -> str:
+        root = f"http://127.0.0.1:{self.server_address[1]}"
+        if self.provider == "cloudflare":
+            return f"{root}/client/v4"
+        return f"{root}/api/json/"
+
+    def start(self) -> "FakeAPIServer":
+        threading.Thread(
+            target=self.serve_forever, name=f"fake-{self.provider}", daemon=True
+        ).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve a fake DNS provider API")
+    parser.add_argument("--provider", choices=sorted(HANDLERS), default="cloudflare")
+    parser.add_argument("--zone", default="bench.test")
+    parser.add_argument("--port", type=int, default=8053)
+    parser.add_argument("--latency", type=float, default=0, help="seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    server = FakeAPIServer(
+        args.provider, FakeDNS(), args.zone, args.port, args.latency, args.error_rate
+    )
+    print(f"fake {args.provider} API for {args.zone} at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+# a local stand-in for an authoritative server that accepts RFC 2136 updates, for the
+# rfc2136 provider. it answers A/AAAA queries, UPDATEs and AXFRs for one zone from a
+# FakeDNS, over UDP and TCP, and insists on TSIG when started with a key
+#
+#   python -m benchmarks.fake_nameserver --port 5353 --key-name anemoi. --key-secret <base64>
+import argparse
+import random
+import socketserver
+import threading
+from time import sleep
+from typing import Optional
+
+import dns.exception
+import dns.message
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+import dns.tsigkeyring
+
+from benchmarks.fake_apis import FakeDNS
+
+
+class FakeNameserver:
+    def __init__(
+        self,
+        dns_records: FakeDNS,
+        zone: str,
+        port: int = 0,
+        key_name: Optional[str] = None,
+        key_secret: Optional[str] = None,
+        latency: float = 0,
+        error_rate: float = 0,
+    ):
+        self.dns = dns_records
+        self.zone = dns.name.from_text(zone)
+        self.keyring = None
+        if key_name and key_secret:
+            self.keyring = dns.tsigkeyring.from_text({key_name: key_secret})
+        self.latency = latency
+        self.error_rate = error_rate
+
+        handle = self.handle
+
+        class UDPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                if response := handle(data):
+                    sock.sendto(response, self.client_address)
+
+        class TCPHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while length := self.rfile.read(2):
+                    data = self.rfile.read(int.from_bytes(length, "big"))
+                    if response := handle(data):
+                        self.wfile.write(len(response).to_bytes(2, "big") + response)
+
+        self.udp = socketserver.ThreadingUDPServer(("127.0.0.1", port), UDPHandler)
+        self.port = self.udp.server_address[1]
+        self.tcp = socketserver.ThreadingTCPServer(("127.0.0.1", self.port), TCPHandler)
+        for server in (self.udp, self.tcp):
+            server.daemon_threads = True
+
+    def start(self) -> "FakeNameserver":
+        for server in (self.udp, self.tcp):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def shutdown(self):
+        for server in (self.udp, self.tcp):
+            server.shutdown()
+            server.server_close()
+
+    def handle(self, data: bytes) -> Optional[bytes]:
+        try:
+            request = dns.message.from_wire(data, keyring=self.keyring)
+        except dns.exception.DNSException:
+            return self.__not_authorized(data)
+        if self.latency:
+            sleep(self.latency)
+        failed = random.random() < self.error_rate
+        with self.dns.lock:
+            self.dns.calls += 1
+            self.dns.errors += failed
+        response = dns.message.make_response(request)
+        if failed:
+            response.set_rcode(dns.rcode.SERVFAIL)
+        elif self.keyring and not request.had_tsig:
+            response.set_rcode(dns.rcode.REFUSED)
+        elif request.opcode() == dns.opcode.UPDATE:
+            self.update(request, response)
+        elif request.opcode() == dns.opcode.QUERY and request.question:
+            self.query(request, response)
+        else:
+            response.set_rcode(dns.rcode.NOTIMP)
+        return response.to_wire()
+
+    # bad or unknown TSIG, answered without a signature like a real server would
+    def __not_authorized(self, data: bytes) -> Optional[bytes]:
+        try:
+            request = dns.message.from_wire(data, keyring=False)
+        except dns.exception.DNSException:
+            return None
+        response = dns.message.make_response(request)
+        response.set_rcode(dns.rcode.NOTAUTH)
+        return response.to_wire()
+
+    def __name(self, name: dns.name.Name) -> str:
+        return name.to_text(omit_final_dot=True)
+
+    def __rrset(self, name: str, rtype: str, records) -> dns.rrset.RRset:
+        return dns.rrset.from_text_list(
+            f"{name}.", 600, "IN", rtype, [x["content"] for x in records]
+        )
+
+    def __soa(self) -> dns.rrset.RRset:
+        return dns.rrset.from_text(
+            self.zone,
+            600,
+            "IN",
+            "SOA",
+            f"ns.{self.zone} admin.{self.zone} 1 60 60 60 60",
+        )
+
+    def query(self, request, response):
+        question = request.question[0]
+        if question.rdtype == dns.rdatatype.AXFR:
+            response.answer.append(self.__soa())
+            response.answer.append(
+                dns.rrset.from_text(self.zone, 600, "IN", "NS", f"ns.{self.zone}")
+            )
+            for record in self.dns.find(zone=self.__name(self.zone)):
+                rrset = self.__rrset(record["name"], record["type"], [record])
+                response.answer.append(rrset)
+            response.answer.append(self.__soa())
+            return
+        name = self.__name(question.name)
+        rtype = dns.rdatatype.to_text(question.rdtype)
+        if not question.name.is_subdomain(self.zone):
+            response.set_rcode(dns.rcode.REFUSED)
+        elif records := self.dns.find(name, rtype):
+            response.answer.append(self.__rrset(name, rtype, records))
+        elif not self.dns.find(name):
+            response.set_rcode(dns.rcode.NXDOMAIN)
+
+    # only what the rfc2136 provider sends: delete an rrset, then add records
+    def update(self, request, response):
+        if request.zone[0].name != self.zone:
+            response.set_rcode(dns.rcode.NOTAUTH)
+            return
+        for rrset in request.update:
+            name = self.__name(rrset.name)
+            rtype = dns.rdatatype.to_text(rrset.rdtype)
+            if rrset.deleting == dns.rdataclass.ANY:
+                self.dns.delete(name, None if rtype == "ANY" else rtype)
+            elif rrset.deleting is None:
+                existing = {x["content"] for x in self.dns.find(name, rtype)}
+                for rdata in rrset:
+                    if rdata.to_text() not in existing:
+                        self.dns.add(name, rtype, rdata.to_text())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve a fake RFC 2136 nameserver")
+    parser.add_argument("--zone", default="bench.test")
+    parser.add_argument("--port", type=int, default=5353)
+    parser.add_argument("--key-name")
+    parser.add_argument("--key-secret", help="base64 TSIG secret")
+    parser.add_argument("--latency", type=float, default=0, help="seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    server = FakeNameserver(
+        FakeDNS(),
+        args.zone,
+        args.port,
+        args.key_name,
+        args.key_secret,
+        args.latency,
+        args.error_rate,
+    )
+    print(f"fake nameserver for {args.zone} at 127.0.0.1:{server.port}")
+    server.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
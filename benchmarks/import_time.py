@@ -0,0 +1,130 @@
+# how long anemoi takes to import for each entry point, measured with
+# `python -X importtime` in a fresh interpreter, and a check that client commands and
+# server workers don't load modules they have no use for. exits non-zero if one does,
+# or if a scenario goes over --max-ms, so it can guard against regressions
+#
+#   python -m benchmarks.import_time --repeat 5 --max-ms 400
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Optional, Set, Tuple
+
+import yaml
+
+# modules that must stay unimported, by scenario. provider SDKs are only loaded when a
+# zone is first used, and the web stacks only by the server commands
+CLIENT_UNWANTED = [
+    "flask",
+    "werkzeug",
+    "uvicorn",
+    "httpx",
+    "requests",
+    "prometheus_client",
+    "cloudflare",
+    "dns",
+]
+SERVER_UNWANTED = ["uvicorn", "httpx", "cloudflare", "dns"]
+
+SCENARIOS = {
+    "cli": ("import anemoi.cli", CLIENT_UNWANTED),
+    "client list": ("-m anemoi.cli -c {config} client list", CLIENT_UNWANTED),
+    "server worker": (
+        "from anemoi.server import setup_server; setup_server('{config}')",
+        SERVER_UNWANTED,
+    ),
+}
+
+
+def write_config(tmp: str) -> str:
+    config = {
+        "domains": [
+            {"zone": "bench.test", "provider": "cloudflare", "token": "benchmark"},
+            {
+                "zone": "bench2.test",
+                "provider": "porkbun",
+                "apikey": "pk1_benchmark",
+                "secret": "sk1_bench",
+            },
+        ],
+        "backend": {"type": "tinydb", "path": os.path.join(tmp, "clients.json")},
+    }
+    path = os.path.join(tmp, "config.yml")
+    with open(path, "w") as fp:
+        yaml.safe_dump(config, fp)
+    return path
+
+
+def importtime(args: List[str]) -> List[Tuple[int, int, str]]:
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        capture_output=True,
+        text=True,
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE="1"),
+    )
+    if res.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed:\n{res.stderr}")
+    imports = []
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|")
+        # skips the header line
+        if self_us.strip().isdigit():
+            imports.append((int(self_us), int(cumulative_us), name.strip()))
+    return imports
+
+
+# returns the import time in ms and every top-level package imported, leaving out
+# whatever a bare interpreter imports at startup
+def measure(command: str, config: str, startup: Set[str]) -> Tuple[float, Dict]:
+    command = command.format(config=config)
+    if command.startswith("-m "):
+        args = shlex.split(command)
+    else:
+        args = ["-c", command]
+    total = 0.0
+    packages: Dict[str, float] = {}
+    for self_us, cumulative_us, name in importtime(args):
+        if name in startup:
+            continue
+        total += self_us
+        # the outermost import of a package carries the time of everything under it
+        package = name.split(".")[0]
+        packages[package] = max(packages.get(package, 0), cumulative_us / 1000)
+    return total / 1000, packages
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="import time per entry point")
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="runs per scenario, the fastest counts"
+    )
+    parser.add_argument("--top", type=int, default=8, help="heaviest packages shown")
+    parser.add_argument("--max-ms", type=float, help="fail if a scenario takes longer")
+    args = parser.parse_args(argv)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        config = write_config(tmp)
+        startup = {x[2] for x in importtime(["-c", "pass"])}
+        for scenario, (command, unwanted) in SCENARIOS.items():
+            runs = [measure(command, config, startup) for _ in range(args.repeat)]
+            total, packages = min(runs, key=lambda x: x[0])
+            print(f"{scenario:<14} {total:8.1f} ms")
+            heaviest = sorted(packages.items(), key=lambda x: -x[1])[: args.top]
+            for package, ms in heaviest:
+                print(f"    {package:<24} {ms:8.1f} ms")
+            if loaded := [x for x in unwanted if x in packages]:
+                print(f"  ! {scenario} imports {', '.join(loaded)}")
+                failed = True
+            if args.max_ms and total > args.max_ms:
+                print(f"  ! {scenario} is over {args.max_ms:.0f} ms")
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+# drives /check-in against a seeded backend and a fake provider API, entirely offline,
+# and reports throughput, latency and how many provider calls each check-in cost
+#
+#   python -m benchmarks.load --backend database --provider cloudflare \
+#       --clients 500 --requests 5000 --concurrency 16 --changed 0.1
+#
+# --server gunicorn or uvicorn runs the server in separate worker processes, which
+# needs gunicorn or the asgi extra installed
+import argparse
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from statistics import median, quantiles
+from time import perf_counter, sleep
+from typing import Dict, List, Optional, Tuple
+
+import requests
+import yaml
+
+from benchmarks.fake_apis import FakeAPIServer, FakeDNS
+from benchmarks.fake_nameserver import FakeNameserver
+from benchmarks.population import IP_COUNT, client_ip, seed
+
+BACKENDS = {
+    "tinydb": {"type": "tinydb", "path": "clients.json"},
+    "tinydb-cached": {"type": "tinydb", "vendor": "cached", "path": "clients.json"},
+    "database": {"type": "database", "vendor": "sqlite", "path": "clients.db"},
+    "journal": {"type": "journal", "path": "clients.log"},
+}
+
+TSIG_KEY = ("anemoi-benchmark.", "YW5lbW9pLWJlbmNobWFyay10c2lnLWtleS0xMjM0NTY=")
+
+# how a check-in response reads, by outcome
+OUTCOMES = (
+    ("queued IP update", "queued"),
+    ("changed IP", "provider"),
+    ("error updating IP", "provider_error"),
+    ("updated IP", "database"),
+    ("not changed", "unchanged"),
+    ("too many requests", "rate_limited"),
+)
+
+
+def start_api(args, dns: FakeDNS):
+    if args.provider == "rfc2136":
+        return FakeNameserver(dns, args.zone, 0, *TSIG_KEY, args.latency).start()
+    return FakeAPIServer(args.provider, dns, args.zone, latency=args.latency).start()
+
+
+def build_config(args, tmp: str, api) -> Dict:
+    domain = {"zone": args.zone, "provider": args.provider}
+    if args.provider == "rfc2136":
+        domain.update({"server": "127.0.0.1", "port": api.port})
+        domain.update({"key_name": TSIG_KEY[0], "key_secret": TSIG_KEY[1]})
+    elif args.provider == "cloudflare":
+        domain.update({"token": "benchmark", "base_url": api.url})
+    else:
+        domain.update(
+            {"apikey": "pk1_benchmark", "secret": "sk1_bench", "uri": api.url}
+        )
+    backend = dict(BACKENDS[args.backend])
+    backend["path"] = os.path.join(tmp, backend["path"])
+    return {
+        "domains": [domain],
+        "backend": backend,
+        "cache": {"record_ttl": args.record_ttl, "synced_ttl": args.synced_ttl},
+        "updates": {"mode": args.updates},
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# returns the server's base url and a function that stops it
+def start_server(args, config: Dict, config_path: str):
+    port = free_port()
+    if args.server == "flask":
+        from werkzeug.serving import make_server
+
+        from anemoi.server import setup_server
+
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        server = make_server("127.0.0.1", port, setup_server(config), threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        stop = server.shutdown
+    else:
+        if args.server == "gunicorn":
+            cmd = ["gunicorn", "-w", str(args.workers), "-b", f"127.0.0.1:{port}"]
+            cmd.append(f'anemoi.server:setup_server("{config_path}")')
+        else:
+            cmd = ["uvicorn", "--factory", "anemoi.asgi:setup_asgi_server"]
+            cmd += ["--workers", str(args.workers), "--port", str(port)]
+            cmd += ["--log-level", "warning"]
+        proc = subprocess.Popen(
+            cmd, env=dict(os.environ, ANEMOI_CONFIG=config_path), stdout=sys.stderr
+        )
+        stop = proc.terminate
+
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(300):
+        try:
+            requests.get(url, timeout=1)
+            return url, stop
+        except requests.ConnectionError:
+            sleep(0.1)
+    stop()
+    raise RuntimeError(f"{args.server} server did not start")
+
+
+class Load:
+    def __init__(self, url: str, clients: List, secret: str, changed: float):
+        self.url = f"{url}/check-in"
+        self.secret = secret
+        self.changed = changed
+        self.uuids = [x.uuid for x in clients]
+        self.ips = [x.last_ip4 for x in clients]
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def __session(self) -> requests.Session:
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    # one check-in from client n, or a random one, with a new IP `changed` of the time
+    def check_in(self, n: Optional[int] = None, change: bool = True) -> Tuple:
+        if n is None:
+            n = random.randrange(len(self.uuids))
+        with self.lock:
+            if change and random.random() < self.changed:
+                self.ips[n] = client_ip(random.randrange(IP_COUNT))
+            ip = self.ips[n]
+        data = {"uuid": self.uuids[n], "secret": self.secret, "ip": ip}
+        start = perf_counter()
+        res = self.__session().post(self.url, json=data)
+        elapsed = perf_counter() - start
+        outcome = "error" if res.status_code >= 500 else "unknown"
+        for prefix, name in OUTCOMES:
+            if res.text.startswith(prefix):
+                outcome = name
+                break
+        return elapsed, outcome
+
+    def run(self, count: int, concurrency: int) -> Tuple[float, List]:
+        start = perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(lambda _: self.check_in(), range(count)))
+        return perf_counter() - start, results
+
+
+# queued updates keep reaching the provider after the last check-in returned
+def wait_for_quiet(dns: FakeDNS, timeout: float = 30):
+    last = -1
+    for _ in range(int(timeout)):
+        if dns.calls == last:
+            return
+        last = dns.calls
+        sleep(1)
+
+
+def report(args, elapsed: float, results: List, dns: FakeDNS):
+    latencies = sorted(x[0] * 1000 for x in results)
+    outcomes = Counter(x[1] for x in results)
+    p99 = quantiles(latencies, n=100)[98] if len(latencies) > 1 else latencies[0]
+    print(
+        f"{args.server} x{args.workers}, {args.backend} backend, {args.provider}, "
+        f"{args.clients} clients, {args.changed:.0%} changed"
+    )
+    print(f"  check-ins       {len(results)} in {elapsed:.2f}s")
+    print(f"  throughput      {len(results) / elapsed:.1f}/s")
+    print(f"  latency p50     {median(latencies):.1f} ms")
+    print(f"  latency p99     {p99:.1f} ms")
+    print(f"  provider calls  {dns.calls / len(results):.3f} per check-in")
+    if dns.errors:
+        print(f"  injected errors {dns.errors}")
+    for outcome, count in outcomes.most_common():
+        print(f"  {outcome:<15} {count}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="check-in load test")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="database")
+    parser.add_argument(
+        "--provider",
+        choices=["cloudflare", "porkbun", "rfc2136"],
+        default="cloudflare",
+    )
+    parser.add_argument(
+        "--server", choices=["flask", "gunicorn", "uvicorn"], default="flask"
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--zone", default="bench.test")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--changed", type=float, default=0.1, help="share of check-ins with a new IP"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="provider seconds per request"
+    )
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--record-ttl", type=float, default=60)
+    parser.add_argument(
+        "--synced-ttl", type=float, default=0, help="trust backend record state"
+    )
+    parser.add_argument("--updates", choices=["sync", "async"], default="sync")
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt cost")
+    parser.add_argument(
+        "--no-warmup",
+        action="store_true",
+        help="don't check every client in once before measuring",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dns = FakeDNS()
+        api = start_api(args, dns)
+        config = build_config(args, tmp, api)
+        config_path = os.path.join(tmp, "config.yml")
+        with open(config_path, "w") as fp:
+            yaml.safe_dump(config, fp)
+        clients, secret = seed(
+            config["backend"], args.clients, args.zone, dns, args.rounds
+        )
+
+        url, stop = start_server(args, config, config_path)
+        try:
+            load = Load(url, clients, secret, args.changed)
+            if not args.no_warmup:
+                # every client's credentials and record end up cached
+                with ThreadPoolExecutor(args.concurrency) as pool:
+                    list(
+                        pool.map(lambda n: load.check_in(n, False), range(len(clients)))
+                    )
+            wait_for_quiet(dns)
+            dns.reset_counts()
+            api.error_rate = args.error_rate
+            elapsed, results = load.run(args.requests, args.concurrency)
+            wait_for_quiet(dns)
+        finally:
+            stop()
+            api.shutdown()
+        report(args, elapsed, results, dns)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# seeds a backend with clients under one zone, and optionally a FakeDNS with a
+# matching A record for each of them
+#
+#   python -m benchmarks.population --type database --vendor sqlite --path bench.db --count 10000
+import argparse
+import ipaddress
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+import bcrypt
+
+from anemoi.backends import init_backend
+from anemoi.client import Client
+from benchmarks.fake_apis import FakeDNS
+
+# 198.18.0.0/15 is set aside for benchmarking
+FIRST_IP = ipaddress.IPv4Address("198.18.0.0")
+IP_COUNT = 2**17
+
+
+def client_ip(n: int) -> str:
+    return str(FIRST_IP + n % IP_COUNT)
+
+
+# every client shares one secret, so only one bcrypt hash has to be made. check-ins
+# still pay for a bcrypt check per client, at the given cost
+def make_clients(count: int, zone: str, rounds: int = 12) -> Tuple[List[Client], str]:
+    secret = "benchmark-secret"
+    secret_key = bcrypt.hashpw(secret.encode(), bcrypt.gensalt(rounds)).decode()
+    clients = [
+        Client(f"c{i}.{zone}", str(uuid4()), secret_key, client_ip(i), "")
+        for i in range(count)
+    ]
+    return clients, secret
+
+
+def add_clients(config: Dict, clients: List[Client]):
+    backend = init_backend({"backend": config})
+    backend.connect()
+    backend.add_clients(clients)
+    backend.close()
+    if shutdown := getattr(backend, "shutdown", None):
+        shutdown()
+
+
+def seed(
+    config: Dict,
+    count: int,
+    zone: str = "bench.test",
+    dns: Optional[FakeDNS] = None,
+    rounds: int = 12,
+) -> Tuple[List[Client], str]:
+    clients, secret = make_clients(count, zone, rounds)
+    add_clients(config, clients)
+    if dns is not None:
+        for client in clients:
+            dns.add(client.domain, "A", client.last_ip4)
+    return clients, secret
+
+
+def main():
+    parser = argparse.ArgumentParser(description="seed a backend with clients")
+    parser.add_argument("--type", default="database")
+    parser.add_argument(
+        "--vendor", help="sqlite/postgres for database, cached for tinydb"
+    )
+    parser.add_argument("--path", required=True)
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--zone", default="bench.test")
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt cost")
+    args = parser.parse_args()
+
+    vendor = args.vendor or ("sqlite" if args.type == "database" else "tinydb")
+    config = {"type": args.type, "vendor": vendor, "path": args.path}
+    _, secret = seed(config, args.count, args.zone, rounds=args.rounds)
+    print(f"added {args.count} clients under {args.zone}, secret: {secret}")
+
+
+if __name__ == "__main__":
+    main()